@@ -0,0 +1,320 @@
+"""批改流水线基准测试：本地模拟OpenAI兼容接口，生成合成作文图片，离线测量吞吐、各阶段延迟和内存峰值
+
+用法：python -m aeg_bench --essays 50 --concurrency 4 --latency 0.5 --error-rate 0.05 --json bench.jsonl
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image, ImageDraw, ImageFont
+
+from aeg_engine import GradingEngine, GradingSettings, close_api_clients, estimate_tokens
+from aeg_metrics import percentile
+from aeg_ocr import OCRBackend, register_backend
+
+try:
+    import resource
+except ImportError:
+    # Windows没有resource模块，只报告tracemalloc的峰值
+    resource = None
+
+ESSAY_ID_PATTERN = re.compile(r"===== 作文 (\d+) =====")
+SAMPLE_ESSAY = (
+    "Dear Chris, I am writing to tell you about the school sports meeting held last week. "
+    "Students from every grade took part in running, jumping and team games. "
+    "Although it rained in the afternoon, everyone kept cheering for their classmates. "
+    "I learned that teamwork and persistence matter more than winning. Yours, Li Hua"
+)
+STAGES = ("ocr", "api", "write")
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    """兼容OpenAI的/chat/completions接口，延迟、错误率和回复长度由server上的参数控制"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.requests += 1
+            inject_error = server.random.random() < server.error_rate
+            if inject_error:
+                server.errors += 1
+        if inject_error:
+            self.send_json(server.error_status, {"error": {"message": "mock rate limit", "type": "rate_limit"}},
+                           {"Retry-After": str(server.retry_after)})
+            return
+        time.sleep(server.latency)
+        messages = body["messages"]
+        prompt = "\n".join(message["content"] for message in messages)
+        text = self.reply_text(messages[-1]["content"])
+        usage = {"prompt_tokens": estimate_tokens(prompt), "completion_tokens": estimate_tokens(text)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        if body.get("stream"):
+            self.send_stream(body["model"], text, usage)
+        else:
+            time.sleep(server.token_delay * len(self.chunks(text)))
+            self.send_json(200, {
+                "id": "bench", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+    def reply_text(self, content):
+        """单篇回复带<score>标签；合批请求按作文编号回复JSON数组"""
+        comment = " ".join(["不错"] * max(1, self.server.completion_tokens // 2))
+        ids = ESSAY_ID_PATTERN.findall(content)
+        if ids:
+            return json.dumps([{"id": int(essay_id), "score": f"{10 + int(essay_id) % 5}分", "comment": comment}
+                               for essay_id in ids], ensure_ascii=False)
+        score = int(hashlib.md5(content.encode("utf-8")).hexdigest(), 16) % 15
+        if self.server.score_noise:
+            # 模拟同一篇作文多次评分的波动
+            with self.server.lock:
+                score += self.server.random.randint(-self.server.score_noise, self.server.score_noise)
+            score = min(15, max(0, score))
+        return f"<score>{score}分</> {comment}"
+
+    def chunks(self, text):
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+    def send_json(self, status, obj, headers=None):
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, model, text, usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send_event(data):
+            data = f"data: {data}\n\n".encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        base = {"id": "bench", "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+        try:
+            for piece in self.chunks(text):
+                time.sleep(self.server.token_delay)
+                send_event(json.dumps(dict(base, choices=[
+                    {"index": 0, "delta": {"content": piece}, "finish_reason": None}]), ensure_ascii=False))
+            send_event(json.dumps(dict(base, choices=[], usage=usage)))
+            send_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # 只要分数模式下客户端拿到分数就会断开
+            pass
+
+def start_mock_server(latency=0.5, token_delay=0.01, error_rate=0.0, error_status=429, retry_after=0.5,
+                      completion_tokens=60, seed=0, score_noise=0):
+    """在本机随机端口启动模拟接口，返回server（server.base_url为接口地址）"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockLLMHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.token_delay = token_delay
+    server.error_rate = error_rate
+    server.error_status = error_status
+    server.retry_after = retry_after
+    server.completion_tokens = completion_tokens
+    server.score_noise = score_noise
+    server.random = random.Random(seed)
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.errors = 0
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    threading.Thread(target=server.serve_forever, name="模拟接口", daemon=True).start()
+    return server
+
+class BenchOCRBackend(OCRBackend):
+    """不依赖Tesseract的模拟OCR：等待固定时间后返回样例作文，用于没有安装Tesseract的环境"""
+    name = "bench"
+    delay = 0.2
+
+    def version(self):
+        return "bench"
+
+    def image_to_string(self, img, lang):
+        time.sleep(self.delay)
+        # 用缩略图指纹区分不同图片，避免同批作文被当成重复内容合并请求
+        fingerprint = hashlib.md5(img.convert("L").resize((32, 32)).tobytes()).hexdigest()[:8]
+        return f"{SAMPLE_ESSAY} ({fingerprint})"
+
+register_backend(BenchOCRBackend.name, BenchOCRBackend)
+
+def make_images(out_dir, count, size):
+    """生成合成作文图片：纸色背景上的多行英文，每张内容不同，避免被去重"""
+    try:
+        font = ImageFont.load_default(size=max(12, size[0] // 40))
+    except TypeError:
+        # Pillow 10.1以前的默认字体不能指定字号
+        font = ImageFont.load_default()
+    paths = []
+    for i in range(count):
+        img = Image.new("RGB", size, (235, 230, 220))
+        draw = ImageDraw.Draw(img)
+        y = size[1] // 10
+        for line_no, sentence in enumerate(SAMPLE_ESSAY.split(". ")):
+            draw.text((size[0] // 12, y), f"{i}-{line_no} {sentence}.", fill=(40, 40, 40), font=font)
+            y += size[0] // 20
+        path = os.path.join(out_dir, f"essay_{i:04d}.png")
+        img.save(path, compress_level=1)
+        paths.append(path)
+    return paths
+
+def summarize(results, wall_seconds):
+    """汇总吞吐和各阶段p50/p95；queue为排队等待时间（总耗时减去各阶段耗时）"""
+    processed = [r for r in results if r["status"] in ("written", "failed")]
+    latencies = {stage: [] for stage in STAGES + ("queue", "total")}
+    for result in processed:
+        stages = result.get("stages") or {}
+        for stage in STAGES:
+            if stage in stages:
+                latencies[stage].append(stages[stage])
+        if result.get("latency") is not None:
+            latencies["total"].append(result["latency"])
+            latencies["queue"].append(max(0.0, result["latency"] - sum(stages.values())))
+    written = sum(1 for r in processed if r["status"] == "written")
+    return {
+        "essays": len(results),
+        "written": written,
+        "failed": len(processed) - written,
+        "wall_seconds": round(wall_seconds, 3),
+        "essays_per_minute": round(written / wall_seconds * 60, 2) if wall_seconds else None,
+        "latency": {stage: {"p50": percentile(values, 50), "p95": percentile(values, 95)}
+                    for stage, values in latencies.items() if values},
+    }
+
+def peak_rss_mb():
+    """进程常驻内存峰值（MB），Linux上ru_maxrss单位为KB，macOS为字节"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def run_benchmark(args):
+    work_dir = tempfile.mkdtemp(prefix="aeg_bench_")
+    server = start_mock_server(args.latency, args.token_delay, args.error_rate, args.error_status,
+                               args.retry_after, args.completion_tokens, args.seed, args.score_noise)
+    try:
+        image_dir = os.path.join(work_dir, "images")
+        os.makedirs(image_dir)
+        width, height = (int(v) for v in args.image_size.lower().split("x"))
+        paths = make_images(image_dir, args.essays, (width, height))
+
+        BenchOCRBackend.delay = args.ocr_delay
+        settings = GradingSettings(
+            api_type="DeepSeek", api_key="bench", base_url=server.base_url, deepthink=False,
+            max_concurrency=args.concurrency, ocr_workers=args.ocr_workers, stream=not args.no_stream,
+            score_only=args.score_only, batch_size=args.batch_size, llm_cache=False,
+            cache_file=os.path.join(work_dir, "cache.sqlite"), ocr_backend=args.ocr,
+            preprocess=not args.no_preprocess, image_format=args.image_format, ensemble=args.ensemble,
+        )
+        engine = GradingEngine(settings)
+        if args.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        results, stats = engine.run(paths, "My School Sports Meeting", "满分15分，按内容、语言和结构评分",
+                                    out_dir=os.path.join(work_dir, "out"))
+        wall = time.perf_counter() - start
+        report = summarize(results, wall)
+        if args.trace_memory:
+            report["tracemalloc_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+            tracemalloc.stop()
+        report["peak_rss_mb"] = peak_rss_mb()
+        report["ocr_backend"] = engine.get_ocr_backend().name
+        report["mock_requests"] = server.requests
+        report["mock_errors"] = server.errors
+        report["retries"] = stats["retries"]
+        report["tokens"] = stats.get("prompt_tokens", 0) + stats.get("completion_tokens", 0)
+        report["estimated_usage_requests"] = stats.get("estimated_usage_requests", 0)
+        if args.ensemble:
+            report["ensemble_passes"] = stats.get("ensemble_passes", 0)
+            report["ensemble_escalations"] = stats.get("ensemble_escalations", 0)
+            report["ensemble_extra_tokens"] = stats.get("ensemble_extra_tokens", 0)
+        return report
+    finally:
+        server.shutdown()
+        server.server_close()
+        close_api_clients()
+        if args.keep:
+            print(f"测试文件保留在：{work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def print_report(report):
+    print(f"OCR后端: {report['ocr_backend']}")
+    print(f"作文数: {report['essays']}  成功: {report['written']}  失败: {report['failed']}")
+    print(f"总耗时: {report['wall_seconds']:.2f}秒  吞吐: {report['essays_per_minute']} 篇/分钟")
+    print(f"模拟接口请求: {report['mock_requests']}  注入错误: {report['mock_errors']}  重试: {report['retries']}")
+    if report.get("estimated_usage_requests"):
+        print(f"token数: {report['tokens']}（其中{report['estimated_usage_requests']}次请求未返回用量，为估算值）")
+    else:
+        print(f"token数: {report['tokens']}")
+    if "ensemble_passes" in report:
+        print(f"多次评分: 共{report['ensemble_passes']}次  交给推理模型: {report['ensemble_escalations']}篇  "
+              f"额外token数: {report['ensemble_extra_tokens']}")
+    for stage, values in report["latency"].items():
+        print(f"  {stage:<6} p50 {values['p50']:.3f}s  p95 {values['p95']:.3f}s")
+    if report.get("tracemalloc_peak_mb") is not None:
+        print(f"Python内存峰值(tracemalloc): {report['tracemalloc_peak_mb']} MB")
+    if report.get("peak_rss_mb") is not None:
+        print(f"进程内存峰值(RSS): {report['peak_rss_mb']} MB")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="aeg_bench", description="批改流水线基准测试（离线，不消耗API额度）")
+    parser.add_argument("--essays", type=int, default=20, help="合成作文图片数")
+    parser.add_argument("--image-size", default="1240x1754", help="图片尺寸，默认150dpi的A4")
+    parser.add_argument("--concurrency", type=int, default=4, help="API并发数")
+    parser.add_argument("--ocr-workers", type=int, default=2, help="OCR线程数")
+    parser.add_argument("--batch-size", type=int, default=1, help="每次请求批改的作文篇数")
+    parser.add_argument("--no-stream", action="store_true", help="关闭流式输出")
+    parser.add_argument("--score-only", action="store_true", help="拿到分数即停止生成")
+    parser.add_argument("--ocr", default="bench", help="OCR后端：bench（模拟，默认）、pytesseract、tesserocr、auto")
+    parser.add_argument("--ocr-delay", type=float, default=0.2, help="模拟OCR每张耗时（秒）")
+    parser.add_argument("--no-preprocess", action="store_true", help="关闭OCR前的图片预处理")
+    parser.add_argument("--image-format", default="original", choices=("original", "jpeg", "png"), help="结果图片格式")
+    parser.add_argument("--latency", type=float, default=0.5, help="模拟接口首字节延迟（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="模拟接口每个分块的间隔（秒）")
+    parser.add_argument("--completion-tokens", type=int, default=60, help="模拟回复的大致token数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="注入错误的请求比例（0-1）")
+    parser.add_argument("--error-status", type=int, default=429, help="注入错误的HTTP状态码")
+    parser.add_argument("--retry-after", type=float, default=0.5, help="注入错误时返回的Retry-After（秒）")
+    parser.add_argument("--seed", type=int, default=0, help="错误注入和分数波动的随机种子")
+    parser.add_argument("--ensemble", action="store_true", help="开启多次评分")
+    parser.add_argument("--score-noise", type=int, default=0, help="模拟分数的随机波动幅度（分）")
+    parser.add_argument("--no-trace-memory", dest="trace_memory", action="store_false",
+                        help="不用tracemalloc统计内存（tracemalloc会拖慢运行）")
+    parser.add_argument("--json", help="把结果追加到JSONL文件，便于跨版本对比")
+    parser.add_argument("--keep", action="store_true", help="保留生成的图片和批改结果")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args)
+    print_report(report)
+    if args.json:
+        record = {"time": datetime.datetime.now().isoformat(timespec="seconds"),
+                  "params": {k: v for k, v in vars(args).items() if k not in ("json", "keep")}, "report": report}
+        with open(args.json, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return 0 if report["failed"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
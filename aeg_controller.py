@@ -0,0 +1,185 @@
+"""批改任务控制：批改和API测试在后台线程运行，通过线程安全的事件队列与界面通信，支持暂停、继续和取消
+
+界面线程定时调用JobController.poll()取出事件处理，后台线程从不直接操作Tk控件。
+"""
+import contextlib
+import logging
+import queue
+import threading
+
+class RunControl:
+    """一次批改的暂停/取消状态：批改引擎在每次OCR和API请求前调用wait()，进行中的流式请求登记后可被取消中断"""
+
+    def __init__(self):
+        self.running = threading.Event()
+        self.running.set()
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock()
+        self.inflight = set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    @property
+    def paused(self):
+        return not self.running.is_set()
+
+    def pause(self):
+        """暂停：不再开始新的OCR和请求，已发出的请求继续完成"""
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def cancel(self):
+        """取消：不再开始新的OCR和请求，并关闭进行中的流式请求"""
+        self.cancel_event.set()
+        # 唤醒暂停中等待的线程，让它们看到取消
+        self.running.set()
+        with self.lock:
+            inflight, self.inflight = list(self.inflight), set()
+        for handle in inflight:
+            try:
+                handle.close()
+            except Exception as e:
+                logging.warning(f"[任务] 中断请求失败: {e}")
+
+    def wait(self):
+        """暂停时阻塞到继续或取消，已取消时返回False"""
+        self.running.wait()
+        return not self.cancelled
+
+    def sleep(self, seconds):
+        """重试前的等待，取消时立即返回"""
+        self.cancel_event.wait(seconds)
+
+    @contextlib.contextmanager
+    def track(self, handle):
+        """请求进行期间登记handle（需有close方法），取消时关闭它"""
+        with self.lock:
+            self.inflight.add(handle)
+        if self.cancelled:
+            handle.close()
+        try:
+            yield handle
+        finally:
+            with self.lock:
+                self.inflight.discard(handle)
+
+class JobController:
+    """同一时刻只运行一个批改任务；后台线程的进度和结果以(事件名, 数据)放入队列，由界面线程poll()取出
+
+    设置了scheduler（省钱模式调度）时，调度正在批改期间不能开始手动批改，暂停、继续和取消作用于调度中的任务。
+    """
+
+    def __init__(self, engine, scheduler=None):
+        self.engine = engine
+        self.scheduler = scheduler
+        self.events = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.control = None
+
+    @property
+    def busy(self):
+        """本控制器的后台任务（批改或API测试）正在运行"""
+        with self.lock:
+            return self.thread is not None and self.thread.is_alive()
+
+    @property
+    def scheduler_busy(self):
+        return self.scheduler is not None and self.scheduler.busy
+
+    @property
+    def grading(self):
+        """手动批改、API测试或省钱模式任务正在进行，此时不能开始新的批改"""
+        return self.busy or self.scheduler_busy
+
+    def active(self):
+        """暂停、继续和取消的对象：本控制器的批改，没有时为省钱模式调度中的任务"""
+        if self.busy and self.control is not None:
+            return self.control
+        if self.scheduler_busy:
+            return self.scheduler
+        return None
+
+    @property
+    def paused(self):
+        active = self.active()
+        return active is not None and active.paused
+
+    def post(self, event, data=None):
+        """后台线程调用，线程安全"""
+        self.events.put((event, data))
+
+    def poll(self, limit=200):
+        """界面线程调用，取出已到达的事件（每次最多limit个，避免大批量时卡住界面）"""
+        events = []
+        while len(events) < limit:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        return events
+
+    def start_task(self, target, name):
+        """在后台线程运行target()，已有任务在运行时返回False；target抛出的异常作为error事件发出"""
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return False
+
+            def run():
+                try:
+                    target()
+                except Exception as e:
+                    logging.exception(f"[任务] {name}出错")
+                    self.post("error", f"{name}出错: {e}")
+
+            self.thread = threading.Thread(target=run, name=name, daemon=True)
+            self.thread.start()
+        return True
+
+    def start_grading(self, image_paths, title, criteria, out_dir):
+        """开始批改，事件：progress(已完成数, 总数, 结果)、status(文字)、metrics(快照)、done(输出目录, 统计)"""
+        if self.grading:
+            return False
+        control = self.control = RunControl()
+
+        def work():
+            self.engine.control = control
+            try:
+                _, stats = self.engine.run(
+                    image_paths, title, criteria, out_dir=out_dir,
+                    on_progress=lambda done, total, result: self.post("progress", (done, total, result)),
+                    on_status=lambda text: self.post("status", text),
+                    on_metrics=lambda snapshot: self.post("metrics", snapshot),
+                )
+            finally:
+                self.engine.control = None
+            self.post("done", (out_dir, stats))
+
+        return self.start_task(work, "批改")
+
+    def test_api(self, prompt):
+        """后台测试API，事件：api_test(回复内容)"""
+        if self.busy:
+            return False
+        # API测试不能暂停或取消，不沿用上一次批改的控制状态
+        self.control = None
+        return self.start_task(lambda: self.post("api_test", self.engine.ask_ai(prompt)[0]), "测试API")
+
+    def pause(self):
+        active = self.active()
+        if active is not None:
+            active.pause()
+
+    def resume(self):
+        active = self.active()
+        if active is not None:
+            active.resume()
+
+    def cancel(self):
+        active = self.active()
+        if active is not None:
+            active.cancel()
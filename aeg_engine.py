@@ -0,0 +1,1945 @@
+"""批改引擎：OCR、AI批改和结果输出，不依赖tkinter，可被GUI导入，也可以命令行运行
+
+用法：python -m aeg_engine grade --dir 图片目录 --title 作文题目 --criteria-file 评分标准.txt
+"""
+import argparse
+import contextlib
+import configparser
+import csv
+import os
+from PIL import Image, ImageDraw, ImageFont
+import threading
+import sys
+import datetime
+import logging
+import queue
+import re
+import io
+import json
+import time
+import hashlib
+import sqlite3
+import random
+import email.utils
+import functools
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from aeg_metrics import STAGE_LABELS, RunMetrics, append_jsonl, format_snapshot, write_prometheus
+from aeg_ocr import DEFAULT_OCR_BACKEND, create_backend
+from aeg_preprocess import DEFAULT_TARGET_DPI, PREPROCESS_VERSION, format_timings, preprocess_image
+from aeg_tesseract import TesseractFinder
+
+# 全局 system prompt，作为批改作文的基础指令
+SYSTEM_PROMPT = (
+    '''
+    You are a helpful assistant，帮助用户批改高中英语作文
+    1.优先使用中文回答
+    2.除非用户要求输出其他内容，否则不要过多分析只输出分数，不要建议
+    3.识别不到就打0分
+    4.无论何时输出分数都用这个格式：<score>**分</>，方便中介程序调用
+    '''
+)
+
+CONFIG_FILE = "aeg_config.ini"
+# 缓存数据库与配置文件放在同一目录
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(CONFIG_FILE)), "aeg_cache.sqlite")
+DEFAULT_OCR_CACHE_MB = 50
+DEFAULT_LLM_CACHE_MB = 100
+
+# 各API类型对应的接口地址
+PROVIDER_BASE_URLS = {
+    "ChatGPT": "https://api.openai.com/v1",
+    "DeepSeek": "https://api.deepseek.com",
+}
+API_TIMEOUT = 600
+# 重试与限流：rpm/tpm为0表示不限制
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RPM = 0
+DEFAULT_TPM = 0
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+# 还没有历史数据时，估算单次回复的token数
+DEFAULT_COMPLETION_ESTIMATE = 500
+# 流式输出时刷新界面的最小间隔（秒）
+STREAM_UPDATE_INTERVAL = 0.3
+
+# 批改任务日志，放在批改结果目录，用于断点续批
+JOURNAL_FILE = "journal.jsonl"
+# 每次运行的清单放在批改结果目录下的runs子目录，汇总只针对本次运行
+RUNS_DIR = "runs"
+SUMMARY_FIELDS = ["image", "status", "score", "prompt_tokens", "completion_tokens", "tokens_estimated", "cached",
+                  "latency", "passes", "spread"]
+
+# 批改结果图片上使用的中文字体候选
+if sys.platform.startswith("win"):
+    FONT_CANDIDATES = [
+        "C:/Windows/Fonts/msyh.ttc",
+        "C:/Windows/Fonts/simhei.ttf",
+        "C:/Windows/Fonts/simsun.ttc",
+        "C:/Windows/Fonts/NotoSansSC-Regular.otf"
+    ]
+elif sys.platform == "darwin":
+    FONT_CANDIDATES = [
+        "/System/Library/Fonts/PingFang.ttc",
+        "/System/Library/Fonts/STHeiti Medium.ttc",
+        "/Library/Fonts/Songti.ttc",
+        "/Library/Fonts/SimHei.ttf",
+        "/Library/Fonts/NotoSansSC-Regular.otf"
+    ]
+else:
+    FONT_CANDIDATES = [
+        "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+        "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
+        "/usr/share/fonts/truetype/arphic/ukai.ttc",
+        "/usr/share/fonts/truetype/arphic/uming.ttc"
+    ]
+# 字号按图片宽度取比例（1000像素宽约为原来的40号），并取整到4的倍数，避免缓存过多字号
+SCORE_FONT_RATIO = 0.04
+COMMENT_FONT_RATIO = 0.025
+MIN_FONT_SIZE = 16
+# 图片上叠加的简短评语最多字数和行数
+COMMENT_MAX_CHARS = 60
+COMMENT_MAX_LINES = 3
+# 批改后图片的保存格式：original保持原格式，jpeg/png统一转换
+IMAGE_FORMATS = ("original", "jpeg", "png")
+DEFAULT_JPEG_QUALITY = 90
+# PNG压缩级别0-9，越高越慢；300dpi扫描件用1即可，写结果不再成为瓶颈
+DEFAULT_PNG_COMPRESS_LEVEL = 1
+
+OCR_LANG = "eng+chi_sim"
+OCR_FAILED = "[图片识别失败]"
+AI_FAILED = "[AI批改失败]"
+
+class RequestCancelled(Exception):
+    """批改被取消，流式请求在收到完整回复前被中断"""
+
+# 并发默认值：API 并发数受服务商限流约束，OCR 线程数受 CPU 核数约束
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_OCR_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+# 多篇合批：默认每次请求1篇（不合批），合批时按估算的作文token数切分
+DEFAULT_BATCH_SIZE = 1
+DEFAULT_BATCH_TOKEN_BUDGET = 6000
+# 合批时等待下一篇OCR结果的最长时间（秒），超时就先发出已凑齐的部分
+BATCH_WAIT_SECONDS = 2
+
+BATCH_INSTRUCTION = (
+    "下面会一次给出多篇学生作文，每篇以“===== 作文 编号 =====”开头。\n"
+    "请按评分标准逐篇批改，只输出一个JSON数组，不要输出其他任何内容，格式：\n"
+    '[{"id": 编号, "score": "**分", "comment": "简短评语"}]'
+)
+
+# 运行指标的刷新间隔（秒）：更新进度面板并导出
+DEFAULT_METRICS_INTERVAL = 1.0
+
+# 多次评分：先并发评分passes次，分数相差不超过tolerance即采用；否则逐次追加，最多max_passes次，
+# 仍不一致时交给推理模型评分
+DEFAULT_ENSEMBLE_PASSES = 2
+DEFAULT_ENSEMBLE_MAX_PASSES = 4
+DEFAULT_ENSEMBLE_TOLERANCE = 1.0
+ESCALATION_MODEL = "deepseek-reasoner"
+SCORE_NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)?")
+
+# 流水线阶段结束标记
+_STAGE_DONE = object()
+
+@dataclass
+class EssayRecord:
+    """单篇作文在流水线中的记录：图片只解码一次、只OCR一次，各阶段共用"""
+    path: str
+    image: object = None
+    image_data: bytes = None
+    image_hash: str = ""
+    ocr_text: str = ""
+    result: str = ""
+    usage: dict = None
+    cached: bool = False
+    score: str = ""
+    started: float = 0.0
+    # 各阶段耗时（秒）：ocr、api、write
+    stage_times: dict = field(default_factory=dict)
+    # 多次评分的各次分数、极差和额外token数，未开启时为None
+    ensemble: dict = None
+
+class SqliteLRUCache:
+    """基于SQLite的持久化LRU缓存，值以JSON保存，按总字节数淘汰最久未使用的条目"""
+
+    def __init__(self, path, table, max_bytes):
+        self.table = table
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_last_used ON {table}(last_used)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}").fetchone()[0]
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(f"UPDATE {self.table} SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        data = json.dumps(value, ensure_ascii=False)
+        size = len(data.encode("utf-8"))
+        with self.lock:
+            row = self.conn.execute(f"SELECT size FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.total_bytes -= row[0]
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, data, size, time.time())
+            )
+            self.total_bytes += size
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        # 超出容量时按最近使用时间从旧到新删除
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute(
+                f"SELECT key, size FROM {self.table} ORDER BY last_used LIMIT 100"
+            ).fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            for key, size in rows:
+                self.conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class JobJournal:
+    """批改任务日志（追加写入的JSONL），记录每张图片的进度：pending/ocr_done/graded/written/failed"""
+
+    def __init__(self, path, job_id):
+        self.path = path
+        self.job_id = job_id
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 程序中途退出时最后一行可能不完整
+                        continue
+                    # 只认同一任务（题目、评分标准、模型都相同）的记录
+                    if entry.get("job") == job_id:
+                        self.entries.setdefault(entry["image"], {}).update(entry)
+        self.file = open(path, "a", encoding="utf-8")
+
+    def get(self, image):
+        return self.entries.get(image, {})
+
+    def state(self, image):
+        return self.get(image).get("state")
+
+    def record(self, image, state, **data):
+        entry = dict(data, time=datetime.datetime.now().isoformat(timespec="seconds"),
+                     job=self.job_id, image=image, state=state)
+        with self.lock:
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.file.flush()
+            self.entries.setdefault(image, {}).update(entry)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class RunManifest:
+    """本次运行的清单（JSONL）：每篇作文完成时追加一条，同时累计总数，汇总时只需顺序读一遍"""
+
+    def __init__(self, out_dir):
+        # 精确到微秒并加随机后缀，同一秒内多次运行也不会写进同一个清单
+        self.run_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f") + "_" + uuid.uuid4().hex[:6]
+        runs_dir = os.path.join(out_dir, RUNS_DIR)
+        os.makedirs(runs_dir, exist_ok=True)
+        self.path = os.path.join(runs_dir, f"run_{self.run_id}.jsonl")
+        self.lock = threading.Lock()
+        self.totals = {
+            "essays": 0, "written": 0, "failed": 0, "skipped": 0, "cancelled": 0,
+            "prompt_tokens": 0, "completion_tokens": 0,
+            "cached_prompt_tokens": 0, "cached_completion_tokens": 0,
+            "latency": 0.0, "ensemble_extra_tokens": 0, "estimated_token_essays": 0,
+        }
+        self.file = open(self.path, "x", encoding="utf-8")
+
+    def append(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.file.flush()
+            totals = self.totals
+            totals["essays"] += 1
+            totals[entry["status"]] += 1
+            # 上次运行已完成的作文不计入本次消耗；缓存命中的用量单独统计
+            if entry["status"] != "skipped":
+                prefix = "cached_" if entry["cached"] else ""
+                totals[prefix + "prompt_tokens"] += entry["prompt_tokens"] or 0
+                totals[prefix + "completion_tokens"] += entry["completion_tokens"] or 0
+                totals["latency"] += entry["latency"] or 0.0
+                if entry.get("tokens_estimated"):
+                    totals["estimated_token_essays"] += 1
+                if entry["ensemble"]:
+                    totals["ensemble_extra_tokens"] += entry["ensemble"]["extra_tokens"]
+                    cached_usage = entry["ensemble"].get("cached_usage") or {}
+                    totals["cached_prompt_tokens"] += cached_usage.get("prompt_tokens") or 0
+                    totals["cached_completion_tokens"] += cached_usage.get("completion_tokens") or 0
+
+    def entries(self):
+        """按完成顺序逐条读出清单"""
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def make_cache_key(*parts):
+    """把若干可JSON序列化的部分组合成稳定的sha256缓存键"""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+# 长期复用的API客户端，按(API类型, 接口地址, 密钥)区分，底层HTTP连接保持keep-alive
+_api_clients = {}
+_api_clients_lock = threading.Lock()
+# 当前线程正在进行的请求的计时信息
+_request_timing = threading.local()
+
+def _trace_request(event_name, info):
+    """httpx连接层回调，记录建立连接和收到首字节的时间"""
+    timing = getattr(_request_timing, "current", None)
+    if timing is None:
+        return
+    now = time.perf_counter()
+    if event_name == "connection.connect_tcp.started":
+        timing["connect_start"] = now
+    elif event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+        timing["connect_end"] = now
+    elif event_name.endswith("receive_response_headers.complete"):
+        timing["first_byte"] = now
+
+def _attach_trace(request):
+    request.extensions["trace"] = _trace_request
+
+def get_api_client(provider, base_url, api_key, max_connections):
+    """取得复用的OpenAI客户端，连接池大小与API并发数一致"""
+    key = (provider, base_url, api_key)
+    with _api_clients_lock:
+        entry = _api_clients.get(key)
+        if entry is not None and entry[1] >= max_connections:
+            return entry[0]
+        if entry is not None:
+            # 并发数调大后按新的连接池大小重建
+            entry[0].close()
+        import httpx
+        from openai import OpenAI
+        http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=API_TIMEOUT,
+            event_hooks={"request": [_attach_trace]}
+        )
+        # 重试由RateLimiter和request_completion统一控制，关闭SDK自带的重试
+        client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+        _api_clients[key] = (client, max_connections)
+        return client
+
+def close_api_clients(keep=None):
+    """关闭不再使用的客户端（修改API类型或密钥后调用）"""
+    with _api_clients_lock:
+        for key in list(_api_clients):
+            if key != keep:
+                client, _ = _api_clients.pop(key)
+                try:
+                    client.close()
+                except Exception as e:
+                    logging.error("[API] 关闭客户端失败: %s", e)
+
+def start_request_timing():
+    timing = {"start": time.perf_counter()}
+    _request_timing.current = timing
+    return timing
+
+def log_request_messages(tag, messages):
+    """debug.log只记录请求大小，完整提示词只在DEBUG级别记录"""
+    chars = sum(len(m["content"]) for m in messages)
+    logging.info("%s 发送请求: %d条消息, %d字符", tag, len(messages), chars)
+    logging.debug("%s 发送内容: %r", tag, messages)
+
+def log_request_timing(tag, timing):
+    """把本次请求的连接/首字节/总耗时写入debug.log"""
+    _request_timing.current = None
+    end = time.perf_counter()
+    if "connect_start" in timing and "connect_end" in timing:
+        connect = f"新建连接 {timing['connect_end'] - timing['connect_start']:.3f}s"
+    else:
+        connect = "复用连接"
+    first_byte = timing.get("first_byte", end) - timing["start"]
+    logging.info("%s 耗时: %s, 首字节 %.3fs, 总计 %.3fs", tag, connect, first_byte, end - timing["start"])
+    return first_byte
+
+class RateLimiter:
+    """令牌桶限流：同时限制每分钟请求数和每分钟token数，并支持按Retry-After整体暂停"""
+
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.cond = threading.Condition()
+        self.request_tokens = float(rpm)
+        self.token_tokens = float(tpm)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        # 按实际usage滚动估算单次回复的token数
+        self.expected_completion = DEFAULT_COMPLETION_ESTIMATE
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        if self.rpm:
+            self.request_tokens = min(self.rpm, self.request_tokens + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.token_tokens = min(self.tpm, self.token_tokens + elapsed * self.tpm / 60)
+
+    def acquire(self, estimated_tokens):
+        """等到额度足够再返回；estimated_tokens为本次请求预计消耗的token数"""
+        # 单次请求超过整个TPM时，最多等桶满
+        need_tokens = min(estimated_tokens, self.tpm) if self.tpm else 0
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    waits = []
+                    if self.rpm and self.request_tokens < 1:
+                        waits.append((1 - self.request_tokens) * 60 / self.rpm)
+                    if self.tpm and self.token_tokens < need_tokens:
+                        waits.append((need_tokens - self.token_tokens) * 60 / self.tpm)
+                    if not waits:
+                        if self.rpm:
+                            self.request_tokens -= 1
+                        if self.tpm:
+                            self.token_tokens -= estimated_tokens
+                        return
+                    wait = max(waits)
+                self.cond.wait(wait)
+
+    def settle(self, estimated_tokens, usage):
+        """请求结束后用实际usage修正预扣的token；请求失败时usage为None，退回预扣额度"""
+        with self.cond:
+            actual = 0
+            if usage:
+                actual = usage.get("total_tokens") or 0
+                completion = usage.get("completion_tokens")
+                if completion:
+                    self.expected_completion = int(self.expected_completion * 0.8 + completion * 0.2)
+            if self.tpm:
+                self.token_tokens = min(self.tpm, self.token_tokens + estimated_tokens - actual)
+            self.cond.notify_all()
+
+    def pause(self, seconds):
+        """服务商要求等待（Retry-After）时，所有请求一起暂停"""
+        with self.cond:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.cond.notify_all()
+
+def is_transient_error(e):
+    """判断是否值得重试：限流、超时、连接中断和服务端错误"""
+    status = getattr(e, "status_code", None)
+    if status is not None:
+        return status in (408, 409, 429) or status >= 500
+    if type(e).__name__ in ("APITimeoutError", "APIConnectionError", "RemoteProtocolError", "ReadTimeout"):
+        return True
+    return isinstance(e, (TimeoutError, ConnectionError))
+
+def get_retry_after(e):
+    """从错误响应头读取Retry-After（秒），没有则返回None"""
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+        return max(0.0, (when - datetime.datetime.now(when.tzinfo)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def retry_delay(attempt):
+    """带抖动的指数退避，避免并发请求同时重试"""
+    return random.uniform(0.5, 1.0) * min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+
+def grading_prompt(title, criteria, ocr_text):
+    return f"作文题目：{title}\n评分标准：{criteria}\n学生作文：{ocr_text}\n请根据评分标准批改并给出建议。"
+
+def build_messages(prompt):
+    """组装发送给大模型的消息列表"""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+def usage_to_dict(usage):
+    """把SDK返回的usage对象转成可缓存的dict"""
+    if usage is None:
+        return None
+    if isinstance(usage, dict):
+        return usage
+    return {
+        "prompt_tokens": getattr(usage, "prompt_tokens", None),
+        "completion_tokens": getattr(usage, "completion_tokens", None),
+        "total_tokens": getattr(usage, "total_tokens", None),
+    }
+
+def build_batch_messages(title, criteria, essays):
+    """组装多篇合批请求；题目、评分标准和说明放在前面且每批相同，便于服务商做前缀缓存"""
+    static_part = f"作文题目：{title}\n评分标准：{criteria}\n{BATCH_INSTRUCTION}"
+    essays_part = "\n\n".join(f"===== 作文 {essay_id} =====\n{text}" for essay_id, text in essays)
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": static_part},
+        {"role": "user", "content": essays_part}
+    ]
+
+def parse_batch_reply(content, essay_ids):
+    """解析合批回复的JSON数组，返回{编号: (分数, 评语)}；格式不对或缺篇时返回None"""
+    if not content:
+        return None
+    start = content.find("[")
+    end = content.rfind("]")
+    if start < 0 or end <= start:
+        return None
+    try:
+        items = json.loads(content[start:end + 1])
+    except ValueError:
+        return None
+    parsed = {}
+    for item in items:
+        if not isinstance(item, dict):
+            return None
+        try:
+            essay_id = int(item.get("id"))
+        except (TypeError, ValueError):
+            return None
+        parsed[essay_id] = (str(item.get("score", "")).strip(), str(item.get("comment", "")).strip())
+    if set(parsed) != set(essay_ids):
+        return None
+    return parsed
+
+def estimate_tokens(text):
+    """粗略估算token数：中文约1字1个token，其他约4个字符1个token"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if "\u4e00" <= ch <= "\u9fff")
+    return cjk + (len(text) - cjk) // 4 + 1
+
+def split_usage(usage, parts):
+    """把合批请求的usage平均分摊到每篇作文"""
+    if not usage or parts <= 0:
+        return [usage] * parts
+    shares = [{} for _ in range(parts)]
+    for name, value in usage.items():
+        if value is None or isinstance(value, bool):
+            # 是否为估算值等标记原样复制
+            for share in shares:
+                share[name] = value
+            continue
+        base, extra = divmod(value, parts)
+        for i, share in enumerate(shares):
+            share[name] = base + (1 if i < extra else 0)
+    return shares
+
+REASONING_MARKER = "\n\n【思维链】\n"
+
+def format_reply(content, reasoning_content):
+    """拼接回复正文和思维链"""
+    if reasoning_content:
+        return content + REASONING_MARKER + reasoning_content
+    return content
+
+SCORE_PATTERN = re.compile(r"<score>(.*?)</>", re.S)
+
+def extract_score(result):
+    """从AI回复中提取<score>标签内的分数"""
+    match = SCORE_PATTERN.search(result or "")
+    if match:
+        return match.group(1).strip()
+    return "无分数"
+
+def score_value(score_text):
+    """分数文字中的第一个数字（如“12分”“12/15”取12），没有数字时返回None"""
+    match = SCORE_NUMBER_PATTERN.search(score_text or "")
+    return float(match.group()) if match else None
+
+def agreeing_scores(values, size, tolerance):
+    """从若干次评分中找出size个相差不超过tolerance的分数（取最集中的一组），找不到返回None"""
+    values = sorted(values)
+    best = None
+    for i in range(len(values) - size + 1):
+        group = values[i:i + size]
+        if group[-1] - group[0] <= tolerance and (best is None or group[-1] - group[0] < best[-1] - best[0]):
+            best = group
+    return best
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+def format_number(value):
+    return str(int(value)) if value == int(value) else f"{value:.1f}"
+
+def sum_usage(usages):
+    """多次请求的usage相加，其中任一次为估算值时结果也标记为估算"""
+    total = {}
+    for usage in usages:
+        for name, value in (usage or {}).items():
+            if isinstance(value, bool):
+                total[name] = total.get(name, False) or value
+            elif isinstance(value, (int, float)):
+                total[name] = total.get(name, 0) + value
+    return total or None
+
+def estimate_usage(messages, content, reasoning_content):
+    """流式回复被提前中止（拿到分数即停止）时服务商不再返回usage，按提示词和已收到的内容估算，并标记为估算"""
+    prompt_tokens = estimate_tokens("".join(m["content"] for m in messages))
+    completion_tokens = estimate_tokens(content) + estimate_tokens(reasoning_content)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens, "estimated": True}
+
+def usage_tokens(usage):
+    usage = usage or {}
+    return (usage.get("prompt_tokens") or 0) + (usage.get("completion_tokens") or 0)
+
+def read_stream(stream, on_score=None, on_delta=None, stop_at_score=False):
+    """逐块读取流式回复，分数标签一出现就回调；stop_at_score为True时拿到分数即中止，返回(正文, 思维链, usage)"""
+    content_parts = []
+    reasoning_parts = []
+    usage = None
+    score = None
+    last_update = 0.0
+    for chunk in stream:
+        if getattr(chunk, "usage", None):
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        reasoning = getattr(delta, "reasoning_content", None)
+        if reasoning:
+            reasoning_parts.append(reasoning)
+        if delta.content:
+            content_parts.append(delta.content)
+            # 分数标签可能被拆到多个块里，只在出现结束符时检查整段正文
+            if score is None and ">" in delta.content:
+                match = SCORE_PATTERN.search("".join(content_parts))
+                if match:
+                    score = match.group(1).strip()
+                    if on_score:
+                        on_score(score)
+                    if stop_at_score:
+                        stream.close()
+                        break
+        if on_delta and (delta.content or reasoning):
+            now = time.perf_counter()
+            if now - last_update >= STREAM_UPDATE_INTERVAL:
+                last_update = now
+                on_delta("".join(content_parts) if content_parts else "".join(reasoning_parts), bool(content_parts))
+    return "".join(content_parts), "".join(reasoning_parts) or None, usage
+
+def start_stage(func, in_queue, out_queue, workers, name, fan_out=False, on_error=None):
+    """启动一个流水线阶段：workers个线程从in_queue取任务，处理结果放入out_queue；fan_out为True时结果是列表，逐个放入。
+    处理出错时由on_error把任务标记为失败后照常放入out_queue，不丢弃"""
+    remaining = [workers]
+    lock = threading.Lock()
+
+    def loop():
+        while True:
+            item = in_queue.get()
+            if item is _STAGE_DONE:
+                # 放回结束标记，让同阶段的其他线程也能退出
+                in_queue.put(_STAGE_DONE)
+                break
+            try:
+                result = func(item)
+            except Exception as e:
+                logging.error("[%s] 异常: %s", name, e)
+                if on_error is None:
+                    continue
+                try:
+                    result = on_error(item)
+                except Exception as e:
+                    logging.error("[%s] 标记失败时异常: %s", name, e)
+                    continue
+            if out_queue is not None:
+                for one in (result if fan_out else [result]):
+                    out_queue.put(one)
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        # 本阶段最后一个线程退出时通知下游
+        if last and out_queue is not None:
+            out_queue.put(_STAGE_DONE)
+
+    threads = [threading.Thread(target=loop, name=f"{name}-{i}", daemon=True) for i in range(workers)]
+    for t in threads:
+        t.start()
+    return threads
+
+def start_batcher(in_queue, out_queue, batch_size, token_budget):
+    """合批阶段：把作文按篇数和token预算分组；batch_size为1时每篇单独一组"""
+
+    def loop():
+        batch = []
+        used = 0
+        while True:
+            try:
+                item = in_queue.get(timeout=BATCH_WAIT_SECONDS)
+            except queue.Empty:
+                # 上游暂时没有新结果，先把凑到的发出去，避免API空等
+                if batch:
+                    out_queue.put(batch)
+                    batch, used = [], 0
+                continue
+            if item is _STAGE_DONE:
+                if batch:
+                    out_queue.put(batch)
+                out_queue.put(_STAGE_DONE)
+                break
+            tokens = estimate_tokens(item.ocr_text)
+            if batch and used + tokens > token_budget:
+                out_queue.put(batch)
+                batch, used = [], 0
+            batch.append(item)
+            used += tokens
+            if len(batch) >= batch_size:
+                out_queue.put(batch)
+                batch, used = [], 0
+
+    thread = threading.Thread(target=loop, name="合批", daemon=True)
+    thread.start()
+    return thread
+
+def output_paths(img_path, out_dir, image_format="original"):
+    """单篇作文的输出文件：批改后的图片和txt"""
+    base = os.path.basename(img_path)
+    stem = os.path.splitext(base)[0]
+    if image_format == "jpeg":
+        base = stem + ".jpg"
+    elif image_format == "png":
+        base = stem + ".png"
+    return os.path.join(out_dir, base), os.path.join(out_dir, stem + ".txt")
+
+@functools.lru_cache(maxsize=None)
+def find_font_path():
+    """找到第一个可用的中文字体，整个进程只探测一次"""
+    for font_path in FONT_CANDIDATES:
+        if os.path.exists(font_path):
+            try:
+                ImageFont.truetype(font_path, MIN_FONT_SIZE)
+                return font_path
+            except Exception:
+                continue
+    return None
+
+@functools.lru_cache(maxsize=32)
+def load_font(font_path, size):
+    """按路径和字号加载字体并缓存，大的.ttc字体不再每篇重新加载"""
+    if font_path:
+        try:
+            return ImageFont.truetype(font_path, size)
+        except Exception as e:
+            logging.warning(f"[字体] 加载失败 {font_path}: {e}")
+    return ImageFont.load_default()
+
+def font_size_for(width, ratio):
+    """按图片宽度计算字号"""
+    return max(MIN_FONT_SIZE, int(width * ratio) // 4 * 4)
+
+def short_comment(result, max_chars=COMMENT_MAX_CHARS):
+    """从AI回复中取一段简短评语：去掉思维链和分数标签，压缩空白后截断"""
+    text = (result or "").split(REASONING_MARKER)[0]
+    text = " ".join(SCORE_PATTERN.sub("", text).split())
+    if len(text) > max_chars:
+        text = text[:max_chars] + "…"
+    return text
+
+def wrap_text(draw, text, font, max_width, max_lines):
+    """按像素宽度逐字折行，超出行数的部分丢弃"""
+    lines = []
+    line = ""
+    for char in text:
+        if line and draw.textlength(line + char, font=font) > max_width:
+            lines.append(line)
+            if len(lines) >= max_lines:
+                return lines
+            line = char
+        else:
+            line += char
+    if line:
+        lines.append(line)
+    return lines
+
+def draw_overlay(img, score_text, comment=""):
+    """在图片左上角写上分数，comment不为空时在分数下方写简短评语"""
+    width = img.size[0]
+    font_path = find_font_path()
+    score_font = load_font(font_path, font_size_for(width, SCORE_FONT_RATIO))
+    margin = max(5, font_size_for(width, SCORE_FONT_RATIO) // 2)
+    draw = ImageDraw.Draw(img)
+    draw.text((margin, 5), score_text, fill=(255, 0, 0), font=score_font)
+    if comment:
+        comment_size = font_size_for(width, COMMENT_FONT_RATIO)
+        comment_font = load_font(font_path, comment_size)
+        y = 5 + font_size_for(width, SCORE_FONT_RATIO) + comment_size // 2
+        for line in wrap_text(draw, comment, comment_font, width - 2 * margin, COMMENT_MAX_LINES):
+            draw.text((margin, y), line, fill=(255, 0, 0), font=comment_font)
+            y += int(comment_size * 1.3)
+    return img
+
+def image_save_options(img_out, jpeg_quality=DEFAULT_JPEG_QUALITY, png_compress_level=DEFAULT_PNG_COMPRESS_LEVEL):
+    """按输出文件类型给出保存参数：关闭optimize，JPEG质量和PNG压缩级别可配置"""
+    ext = os.path.splitext(img_out)[1].lower()
+    if ext in (".jpg", ".jpeg"):
+        return {"format": "JPEG", "quality": jpeg_quality, "optimize": False}
+    if ext == ".png":
+        return {"format": "PNG", "compress_level": png_compress_level, "optimize": False}
+    return {}
+
+def format_essay_text(ocr_text, result, usage, cached, ensemble=None):
+    """单篇作文txt的内容，total.txt中复用同样的格式"""
+    lines = ["【OCR识别内容】", (ocr_text or "[获取OCR内容失败]") + "\n", "【AI批改内容】", (result or "") + "\n"]
+    if ensemble:
+        if ensemble["agreed"] and ensemble["spread"] <= ensemble["tolerance"]:
+            verdict = "分数一致"
+        elif ensemble["agreed"]:
+            verdict = "取其中分数一致的几次的中位数"
+        elif ensemble["escalated"]:
+            verdict = f"分数不一致，已由{ESCALATION_MODEL}评分"
+        else:
+            verdict = "分数不一致，取中位数"
+        lines.append("【多次评分】")
+        lines.append(f"各次分数: {' / '.join(ensemble['scores'])}")
+        line = f"极差: {format_number(ensemble['spread'])}，{verdict}，额外token数: {ensemble['extra_tokens']}"
+        if ensemble.get("cached_usage"):
+            line += f"（另有{ensemble['cached_passes']}次评分命中缓存，用量{usage_tokens(ensemble['cached_usage'])}未计入）"
+        lines.append(line + "\n")
+    if usage:
+        # 只写总token数；缓存命中的用量单独标注，不算实际消耗
+        prompt_tokens = usage.get("prompt_tokens")
+        completion_tokens = usage.get("completion_tokens")
+        prefix = "缓存" if cached else ""
+        lines.append("【API用量统计】")
+        if cached:
+            lines.append("（缓存命中，未实际请求API）")
+        if usage.get("estimated"):
+            lines.append("（服务商未返回用量（如拿到分数即停止生成），以下为估算值）")
+        if prompt_tokens is not None:
+            lines.append(f"{prefix}上传token数: {prompt_tokens}")
+        if completion_tokens is not None:
+            lines.append(f"{prefix}回复token数: {completion_tokens}")
+    return "\n".join(lines) + "\n"
+
+
+# 命令行退出码
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+@dataclass
+class GradingSettings:
+    """一次批改用到的全部设置，GUI和命令行都从aeg_config.ini读取"""
+    api_type: str = "Deepseek"
+    api_key: str = ""
+    # 自定义接口地址（兼容OpenAI的代理或本地测试服务），为空时按API类型选择
+    base_url: str = ""
+    deepthink: bool = True
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+    ocr_workers: int = DEFAULT_OCR_WORKERS
+    stream: bool = True
+    score_only: bool = False
+    batch_size: int = DEFAULT_BATCH_SIZE
+    batch_token_budget: int = DEFAULT_BATCH_TOKEN_BUDGET
+    max_retries: int = DEFAULT_MAX_RETRIES
+    rpm: int = DEFAULT_RPM
+    tpm: int = DEFAULT_TPM
+    bypass_ocr_cache: bool = False
+    llm_cache: bool = True
+    ocr_cache_mb: int = DEFAULT_OCR_CACHE_MB
+    llm_cache_mb: int = DEFAULT_LLM_CACHE_MB
+    cache_file: str = CACHE_FILE
+    tesseract_path: str = None
+    ocr_backend: str = DEFAULT_OCR_BACKEND
+    image_format: str = "original"
+    jpeg_quality: int = DEFAULT_JPEG_QUALITY
+    png_compress_level: int = DEFAULT_PNG_COMPRESS_LEVEL
+    comment_overlay: bool = False
+    # 指标导出：路径为空表示不导出，相对路径放在批改结果目录下
+    metrics_jsonl: str = ""
+    metrics_prometheus: str = ""
+    metrics_interval: float = DEFAULT_METRICS_INTERVAL
+    preprocess: bool = True
+    target_dpi: int = DEFAULT_TARGET_DPI
+    deskew: bool = True
+    binarize: bool = True
+    crop_margin: bool = True
+    ensemble: bool = False
+    ensemble_passes: int = DEFAULT_ENSEMBLE_PASSES
+    ensemble_max_passes: int = DEFAULT_ENSEMBLE_MAX_PASSES
+    ensemble_tolerance: float = DEFAULT_ENSEMBLE_TOLERANCE
+    ensemble_escalate: bool = True
+
+    @classmethod
+    def from_config(cls, config):
+        image_format = config.get("OUTPUT", "image_format", fallback="original").lower()
+        return cls(
+            api_type=config.get("API", "type", fallback="ChatGPT"),
+            api_key=config.get("API", "key", fallback=""),
+            base_url=config.get("API", "base_url", fallback=""),
+            deepthink=config.getboolean("API", "deepthink", fallback=True),
+            max_concurrency=max(1, config.getint("API", "max_concurrency", fallback=DEFAULT_MAX_CONCURRENCY)),
+            ocr_workers=max(1, config.getint("OCR", "workers", fallback=DEFAULT_OCR_WORKERS)),
+            stream=config.getboolean("API", "stream", fallback=True),
+            score_only=config.getboolean("API", "score_only", fallback=False),
+            batch_size=max(1, config.getint("API", "batch_size", fallback=DEFAULT_BATCH_SIZE)),
+            batch_token_budget=config.getint("API", "batch_token_budget", fallback=DEFAULT_BATCH_TOKEN_BUDGET),
+            max_retries=config.getint("API", "max_retries", fallback=DEFAULT_MAX_RETRIES),
+            rpm=config.getint("API", "rpm", fallback=DEFAULT_RPM),
+            tpm=config.getint("API", "tpm", fallback=DEFAULT_TPM),
+            bypass_ocr_cache=config.getboolean("CACHE", "bypass_ocr", fallback=False),
+            llm_cache=config.getboolean("CACHE", "llm", fallback=True),
+            ocr_cache_mb=config.getint("CACHE", "ocr_max_mb", fallback=DEFAULT_OCR_CACHE_MB),
+            llm_cache_mb=config.getint("CACHE", "llm_max_mb", fallback=DEFAULT_LLM_CACHE_MB),
+            cache_file=config.get("CACHE", "file", fallback=CACHE_FILE),
+            tesseract_path=config.get("OCR", "tesseract_path", fallback=None),
+            ocr_backend=config.get("OCR", "backend", fallback=DEFAULT_OCR_BACKEND),
+            image_format=image_format if image_format in IMAGE_FORMATS else "original",
+            jpeg_quality=min(95, max(1, config.getint("OUTPUT", "jpeg_quality", fallback=DEFAULT_JPEG_QUALITY))),
+            png_compress_level=min(9, max(0, config.getint("OUTPUT", "png_compress_level",
+                                                           fallback=DEFAULT_PNG_COMPRESS_LEVEL))),
+            comment_overlay=config.getboolean("OUTPUT", "comment_overlay", fallback=False),
+            metrics_jsonl=config.get("METRICS", "jsonl", fallback=""),
+            metrics_prometheus=config.get("METRICS", "prometheus", fallback=""),
+            metrics_interval=max(0.2, config.getfloat("METRICS", "interval", fallback=DEFAULT_METRICS_INTERVAL)),
+            preprocess=config.getboolean("OCR", "preprocess", fallback=True),
+            target_dpi=max(0, config.getint("OCR", "target_dpi", fallback=DEFAULT_TARGET_DPI)),
+            deskew=config.getboolean("OCR", "deskew", fallback=True),
+            binarize=config.getboolean("OCR", "binarize", fallback=True),
+            crop_margin=config.getboolean("OCR", "crop_margin", fallback=True),
+            ensemble=config.getboolean("ENSEMBLE", "enabled", fallback=False),
+            ensemble_passes=max(2, config.getint("ENSEMBLE", "passes", fallback=DEFAULT_ENSEMBLE_PASSES)),
+            ensemble_max_passes=config.getint("ENSEMBLE", "max_passes", fallback=DEFAULT_ENSEMBLE_MAX_PASSES),
+            ensemble_tolerance=config.getfloat("ENSEMBLE", "tolerance", fallback=DEFAULT_ENSEMBLE_TOLERANCE),
+            ensemble_escalate=config.getboolean("ENSEMBLE", "escalate", fallback=True),
+        )
+
+class GradingEngine:
+    """批改引擎：OCR -> AI批改 -> 写结果的流水线，以及缓存、限流、任务日志"""
+
+    def __init__(self, settings=None):
+        self.settings = settings or GradingSettings()
+        self.metrics = RunMetrics()
+        self.ocr_cache = None
+        self.llm_cache = None
+        self.llm_inflight = {}
+        self.llm_inflight_lock = threading.Lock()
+        self.rate_limiter = None
+        self.ocr_backend = None
+        self.ocr_backend_key = None
+        self.ocr_backend_version = None
+        self.ocr_backend_lock = threading.Lock()
+        self.on_status = None
+        # 限制何时可以发API请求（省钱模式的优惠时段），为None时不限制
+        self.api_gate = None
+        # 本次批改的暂停/取消控制（aeg_controller.RunControl），为None时不可暂停
+        self.control = None
+        # 本次批改同时进行的API请求数上限，多次评分的各次请求也共用，为None时不限制
+        self.api_slots = None
+
+    def notify(self, text):
+        """把一行状态文字交给调用方（GUI日志栏或命令行）"""
+        if self.on_status:
+            self.on_status(text)
+
+    def count(self, name, n=1):
+        """本次批改的计数器（线程安全）"""
+        self.metrics.incr(name, n)
+
+    def wait_control(self):
+        """暂停时阻塞，批改已取消时返回False"""
+        return self.control is None or self.control.wait()
+
+    def cancelled(self):
+        return self.control is not None and self.control.cancelled
+
+    def track_request(self, handle):
+        """进行中的请求登记到控制器，取消批改时关闭以中断请求"""
+        if self.control is None:
+            return contextlib.nullcontext(handle)
+        return self.control.track(handle)
+
+    def get_ocr_cache(self):
+        """打开OCR缓存，失败时返回None，不影响正常批改"""
+        if self.ocr_cache is None:
+            try:
+                self.ocr_cache = SqliteLRUCache(self.settings.cache_file, "ocr_cache", self.settings.ocr_cache_mb * 1024 * 1024)
+            except Exception as e:
+                logging.error("[OCR缓存] 打开失败: %s", e)
+        return self.ocr_cache
+
+    def get_llm_cache(self):
+        """打开大模型回复缓存，配置关闭或打开失败时返回None"""
+        if not self.settings.llm_cache:
+            return None
+        if self.llm_cache is None:
+            try:
+                self.llm_cache = SqliteLRUCache(self.settings.cache_file, "llm_cache", self.settings.llm_cache_mb * 1024 * 1024)
+            except Exception as e:
+                logging.error("[回复缓存] 打开失败: %s", e)
+        return self.llm_cache
+
+    def get_rate_limiter(self):
+        """按配置的每分钟请求数/token数取得限流器，配置变化后重建"""
+        rpm, tpm = self.settings.rpm, self.settings.tpm
+        if self.rate_limiter is None or (self.rate_limiter.rpm, self.rate_limiter.tpm) != (rpm, tpm):
+            self.rate_limiter = RateLimiter(rpm, tpm)
+        return self.rate_limiter
+
+    def ocr_cache_key(self, image_hash):
+        """OCR缓存键：图片内容哈希 + 识别语言 + Tesseract版本 + 预处理选项"""
+        backend = self.get_ocr_backend()
+        if self.ocr_backend_version is None:
+            try:
+                self.ocr_backend_version = backend.version()
+            except Exception:
+                self.ocr_backend_version = "unknown"
+        return make_cache_key(image_hash, OCR_LANG, backend.name, self.ocr_backend_version, self.ocr_options())
+
+    def get_ocr_backend(self):
+        """OCR后端在多次批改之间保留，语言模型不必重新加载；后端或Tesseract路径变化时重新创建"""
+        key = (self.settings.ocr_backend, self.settings.tesseract_path)
+        with self.ocr_backend_lock:
+            if self.ocr_backend is None or self.ocr_backend_key != key:
+                if self.ocr_backend is not None:
+                    self.ocr_backend.close()
+                self.ocr_backend = create_backend(*key)
+                self.ocr_backend_key = key
+                self.ocr_backend_version = None
+                logging.info(f"[OCR] 使用后端: {self.ocr_backend.name}")
+            return self.ocr_backend
+
+    def ocr_options(self):
+        """影响OCR结果的选项，变化后缓存自动失效"""
+        settings = self.settings
+        if not settings.preprocess:
+            return {"preprocess": "none"}
+        return {"preprocess": PREPROCESS_VERSION, "target_dpi": settings.target_dpi, "deskew": settings.deskew,
+                "binarize": settings.binarize, "crop_margin": settings.crop_margin}
+
+    def run(self, image_paths, title, criteria, out_dir=None, on_progress=None, on_status=None, on_metrics=None,
+            ocr_only=False):
+        """批改一批图片，返回(每篇结果列表, 统计)；on_progress(已完成数, 总数, 结果)按完成顺序回调，
+        on_metrics(指标快照)定期回调；ocr_only为True时只做OCR并记入任务日志，之后批改时直接使用"""
+        settings = self.settings
+        if out_dir is None:
+            out_dir = os.path.join(os.path.dirname(image_paths[0]), "批改结果")
+        os.makedirs(out_dir, exist_ok=True)
+        self.on_status = on_status
+        max_concurrency = settings.max_concurrency
+        ocr_workers = max(1, settings.ocr_workers)
+        total = len(image_paths)
+
+        # 流水线：OCR线程池 -> 合批 -> API请求（限制并发数）-> 写结果，阶段间用有界队列连接，内存占用不随图片数增长
+        path_queue = queue.Queue(maxsize=ocr_workers * 2)
+        grade_queue = queue.Queue(maxsize=max_concurrency * 2)
+        batch_queue = queue.Queue(maxsize=max_concurrency * 2)
+        write_queue = queue.Queue(maxsize=max_concurrency * 2)
+        self.api_slots = threading.BoundedSemaphore(max_concurrency)
+        done_count = [0]
+        results = []
+        # 续批跳过的作文在提交线程中完成，其余在写结果线程中完成，进度计数和回调要加锁
+        progress_lock = threading.Lock()
+        # 本次运行的清单，每篇完成时追加，最后据此生成汇总
+        manifest = None if ocr_only else RunManifest(out_dir)
+        metrics = self.metrics = RunMetrics(total, {"ocr": ocr_workers, "api": max_concurrency, "write": 1})
+        metrics.counters.update({"ocr_calls": 0, "ocr_cache_hits": 0, "llm_cache_hits": 0, "llm_dedup_hits": 0,
+                                 "batch_requests": 0, "batch_fallbacks": 0, "resumed": 0, "failed": 0, "retries": 0,
+                                 "cancelled": 0})
+        queues = {"ocr": path_queue, "grade": grade_queue, "api": batch_queue, "write": write_queue}
+        stop_monitor = threading.Event()
+        with self.llm_inflight_lock:
+            self.llm_inflight = {}
+        ocr_cache = self.get_ocr_cache()
+        bypass_ocr_cache = settings.bypass_ocr_cache
+        # 任务日志：同一题目、评分标准和模型再次批改时，从上次停下的地方继续
+        journal = JobJournal(os.path.join(out_dir, JOURNAL_FILE), make_cache_key(title, criteria, self.current_model()))
+
+        def publish_metrics(finished=False):
+            for name, q in queues.items():
+                # 结束后队列里只剩阶段结束标记
+                metrics.set_gauge(name, 0 if finished else q.qsize())
+            snapshot = metrics.snapshot()
+            if on_metrics:
+                on_metrics(snapshot)
+            self.export_metrics(snapshot, out_dir)
+            return snapshot
+
+        def monitor():
+            while not stop_monitor.wait(settings.metrics_interval):
+                publish_metrics()
+
+        def finish(result):
+            # 只做OCR时没有运行清单，也不产生批改结果
+            if manifest is not None:
+                manifest.append(result)
+            metrics.incr("essays_done")
+            if result["latency"] is not None:
+                metrics.observe("total", result["latency"])
+            # 返回给调用方的结果不带OCR全文，避免大批量时占用内存
+            result = {k: v for k, v in result.items() if k != "ocr_text"}
+            with progress_lock:
+                results.append(result)
+                done_count[0] += 1
+                if on_progress:
+                    on_progress(done_count[0], total, result)
+
+        def ocr_stage(record):
+            if not self.wait_control():
+                # 已取消：不再识别，交给下游记为取消
+                return record
+            start = time.perf_counter()
+            try:
+                return ocr_record(record)
+            finally:
+                record.stage_times["ocr"] = time.perf_counter() - start
+                metrics.observe("ocr", record.stage_times["ocr"])
+
+        def ocr_failed(record):
+            # OCR阶段异常（如缓存读取出错）：按识别失败送往下游
+            record.image = None
+            record.image_data = None
+            record.ocr_text = OCR_FAILED
+            return record
+
+        def ocr_record(record):
+            if record.ocr_text:
+                # 上次已完成OCR，图片留到写结果时再解码
+                return record
+            try:
+                with open(record.path, "rb") as f:
+                    record.image_data = f.read()
+            except Exception as e:
+                logging.error("[OCR] 图片读取失败 %s: %s", record.path, e)
+                record.ocr_text = OCR_FAILED
+                return record
+            record.image_hash = hashlib.sha256(record.image_data).hexdigest()
+            key = self.ocr_cache_key(record.image_hash)
+            if ocr_cache is not None and not bypass_ocr_cache:
+                cached = ocr_cache.get(key)
+                if cached is not None:
+                    # 命中缓存：跳过解码和OCR，图片留到写结果时再解码
+                    record.ocr_text = cached
+                    self.count("ocr_cache_hits")
+                    journal.record(record.path, "ocr_done", ocr_text=record.ocr_text)
+                    return record
+            try:
+                record.image = Image.open(io.BytesIO(record.image_data))
+                record.image.load()
+            except Exception as e:
+                logging.error("[OCR] 图片读取失败 %s: %s", record.path, e)
+                record.image = None
+                record.ocr_text = OCR_FAILED
+                return record
+            # 已解码，不再需要原始字节
+            record.image_data = None
+            record.ocr_text = self.ocr_image(record.image)
+            if record.ocr_text != OCR_FAILED:
+                # 识别失败和OCR缓存一样不记录，下次批改时重新识别
+                if ocr_cache is not None:
+                    ocr_cache.put(key, record.ocr_text)
+                journal.record(record.path, "ocr_done", ocr_text=record.ocr_text)
+            return record
+
+        def grade_stage(records):
+            # 上次已批改但没写出结果的作文不再重复请求
+            pending = [record for record in records if not record.result]
+            if not pending or not self.wait_control():
+                return records
+            start = time.perf_counter()
+            if settings.ensemble:
+                # 多次评分逐篇进行，不合批
+                for record in pending:
+                    self.grade_ensemble(record, title, criteria)
+            # 合批失败（回复无法解析）时退回逐篇请求
+            elif not (len(pending) > 1 and self.grade_batch(pending, title, criteria)):
+                for record in pending:
+                    self.grade_single(record, title, criteria)
+            elapsed = time.perf_counter() - start
+            for record in pending:
+                record.stage_times["api"] = elapsed
+                metrics.observe("api", elapsed)
+                if record.result == AI_FAILED and self.cancelled():
+                    # 取消导致的失败不记入任务日志，下次批改时继续
+                    record.result = None
+                elif record.result == AI_FAILED:
+                    journal.record(record.path, "failed", error=AI_FAILED)
+                else:
+                    journal.record(record.path, "graded", result=record.result, usage=record.usage,
+                                   score=record.score, cached=record.cached, ensemble=record.ensemble)
+            return records
+
+        def grade_failed(records):
+            # API阶段异常（如缓存读取出错）：尚未批改的作文按批改失败送往下游
+            for record in records:
+                if not record.result:
+                    record.result = AI_FAILED
+                    journal.record(record.path, "failed", error=AI_FAILED)
+            return records
+
+        def timed_write(record):
+            start = time.perf_counter()
+            written = self.write_result_on_image(record, out_dir)
+            record.stage_times["write"] = time.perf_counter() - start
+            metrics.observe("write", record.stage_times["write"])
+            return written
+
+        def write_stage(record):
+            if not record.result:
+                # 批改取消时尚未完成的作文
+                status = "cancelled"
+                self.count("cancelled")
+            elif record.result == AI_FAILED:
+                # 失败的作文不写结果，留待下次重试
+                status = "failed"
+                self.count("failed")
+            elif timed_write(record):
+                status = "written"
+                journal.record(record.path, "written")
+            else:
+                status = "failed"
+                journal.record(record.path, "failed", error="写结果失败")
+                self.count("failed")
+            # 写完即释放解码后的图片，避免大批量时内存增长
+            record.image = None
+            record.image_data = None
+            finish(essay_result(record.path, status, record.score, record.result, record.usage, record.cached,
+                                ocr_text=record.ocr_text, latency=time.perf_counter() - record.started,
+                                stages=record.stage_times, ensemble=record.ensemble))
+
+        def write_failed(record):
+            # 写结果阶段异常：记为失败，照常计入进度和运行清单
+            record.image = None
+            record.image_data = None
+            self.count("failed")
+            finish(essay_result(record.path, "failed", record.score, record.result, record.usage, record.cached,
+                                ocr_text=record.ocr_text, latency=time.perf_counter() - record.started,
+                                stages=record.stage_times, ensemble=record.ensemble))
+
+        def ocr_done_stage(record):
+            # 只做OCR时识别结果已记入任务日志，释放图片即可
+            if not record.ocr_text:
+                self.count("cancelled")
+            record.image = None
+            record.image_data = None
+            metrics.incr("essays_done")
+            with progress_lock:
+                done_count[0] += 1
+                if on_progress:
+                    on_progress(done_count[0], total, essay_result(record.path, "ocr_done", "", "", None, False))
+
+        threading.Thread(target=monitor, name="指标", daemon=True).start()
+        start_stage(ocr_stage, path_queue, grade_queue, ocr_workers, "OCR", on_error=ocr_failed)
+        if ocr_only:
+            writers = start_stage(ocr_done_stage, grade_queue, None, 1, "OCR完成")
+        else:
+            start_batcher(grade_queue, batch_queue, settings.batch_size, settings.batch_token_budget)
+            start_stage(grade_stage, batch_queue, write_queue, max_concurrency, "API", fan_out=True,
+                        on_error=grade_failed)
+            writers = start_stage(write_stage, write_queue, None, 1, "写结果", on_error=write_failed)
+        for index, img_path in enumerate(image_paths):
+            if self.cancelled():
+                # 取消后剩下的图片不再送入流水线
+                self.count("cancelled", total - index)
+                break
+            entry = journal.get(img_path)
+            state = entry.get("state")
+            graded = state in ("graded", "written") and entry.get("result")
+            # 任务日志中的识别结果：识别失败的（旧版本会记录）不用；要求重新识别时，尚未批改的也不用
+            ocr_text = entry.get("ocr_text", "")
+            if ocr_text == OCR_FAILED or (bypass_ocr_cache and not graded):
+                ocr_text = ""
+            if ocr_only and (state in ("graded", "written") or (ocr_text and state not in (None, "pending"))):
+                # 已经批改过或识别过的不再重复OCR（识别失败的作文不记录识别结果，但可能已经批改过）
+                self.count("resumed")
+                continue
+            outputs = output_paths(img_path, out_dir, settings.image_format)
+            if state == "written" and all(os.path.exists(p) for p in outputs):
+                # 上次已写出结果，直接跳过
+                self.count("resumed")
+                finish(essay_result(img_path, "skipped", entry.get("score", ""), entry.get("result", ""),
+                                    entry.get("usage"), entry.get("cached", False), ocr_text=entry.get("ocr_text", ""),
+                                    ensemble=entry.get("ensemble")))
+                continue
+            record = EssayRecord(path=img_path, started=time.perf_counter())
+            record.ocr_text = ocr_text
+            if graded:
+                record.result = entry["result"]
+                record.usage = entry.get("usage")
+                record.score = entry.get("score", "")
+                record.cached = entry.get("cached", False)
+                record.ensemble = entry.get("ensemble")
+            if state is None:
+                journal.record(img_path, "pending")
+            path_queue.put(record)
+        path_queue.put(_STAGE_DONE)
+        for t in writers:
+            t.join()
+        journal.close()
+        stop_monitor.set()
+        snapshot = publish_metrics(finished=True)
+        self.on_status = None
+        if ocr_only:
+            return [], dict(snapshot["counters"], images=total)
+        manifest.close()
+        stats = dict(snapshot["counters"], images=total, preprocess_seconds=metrics.total_time("preprocess"),
+                     ocr_seconds=metrics.total_time("recognize"), essays_per_minute=snapshot["essays_per_minute"],
+                     bottleneck=snapshot["bottleneck"])
+        logging.info("[批改] 图片数: %d, OCR调用次数: %d, OCR缓存命中: %d, 回复缓存命中: %d, 重复作文合并: %d, "
+                     "合批请求: %d, 合批失败退回逐篇: %d, 续批跳过: %d, 失败: %d, 重试: %d, "
+                     "OCR预处理耗时: %.1fs, OCR识别耗时: %.1fs",
+                     stats["images"], stats["ocr_calls"], stats["ocr_cache_hits"],
+                     stats["llm_cache_hits"], stats["llm_dedup_hits"],
+                     stats["batch_requests"], stats["batch_fallbacks"],
+                     stats["resumed"], stats["failed"], stats["retries"],
+                     stats["preprocess_seconds"], stats["ocr_seconds"])
+        self.write_summary(out_dir, stats, manifest)
+        return results, stats
+
+    def export_metrics(self, snapshot, out_dir):
+        """按配置把指标快照追加到JSONL文件，或写成Prometheus文本文件"""
+        for path, export in ((self.settings.metrics_jsonl, append_jsonl),
+                             (self.settings.metrics_prometheus, write_prometheus)):
+            if not path:
+                continue
+            try:
+                export(os.path.join(out_dir, path), snapshot)
+            except Exception as e:
+                logging.error("[指标] 导出失败 %s: %s", path, e)
+
+    def write_summary(self, out_dir, stats, manifest):
+        """根据本次运行的清单一次顺序读取，同时生成total.txt、summary.csv和summary.json"""
+        totals = manifest.totals
+        processed = totals["written"] + totals["failed"]
+        try:
+            with open(os.path.join(out_dir, "total.txt"), "w", encoding="utf-8") as total_f, \
+                    open(os.path.join(out_dir, "summary.csv"), "w", encoding="utf-8-sig", newline="") as csv_f, \
+                    open(os.path.join(out_dir, "summary.json"), "w", encoding="utf-8") as json_f:
+                now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                total_f.write(f"【统计时间】{now_str}\n")
+                total_f.write(f"【本次运行】{manifest.run_id}\n")
+                total_f.write(f"【总上传token数】: {totals['prompt_tokens']}\n")
+                total_f.write(f"【总回复token数】: {totals['completion_tokens']}\n")
+                if totals.get("estimated_token_essays"):
+                    total_f.write(f"【其中token数为估算的作文】: {totals['estimated_token_essays']}篇"
+                                  "（服务商未返回用量，如拿到分数即停止生成）\n")
+                total_f.write(f"【缓存命中节省上传token数】: {totals['cached_prompt_tokens']}\n")
+                total_f.write(f"【缓存命中节省回复token数】: {totals['cached_completion_tokens']}\n")
+                if processed:
+                    total_f.write(f"【平均每篇耗时】: {totals['latency'] / processed:.1f}秒\n")
+                    total_f.write(f"【吞吐】: {stats['essays_per_minute'] or 0:.1f}篇/分钟\n")
+                if stats["bottleneck"]:
+                    total_f.write(f"【瓶颈阶段】: {STAGE_LABELS[stats['bottleneck']]}\n")
+                total_f.write(f"【图片数】: {stats['images']}\n")
+                total_f.write(f"【OCR调用次数】: {stats['ocr_calls']}\n")
+                total_f.write(f"【OCR缓存命中】: {stats['ocr_cache_hits']}\n")
+                if stats["ocr_calls"]:
+                    total_f.write(f"【OCR预处理耗时】: {stats['preprocess_seconds']:.1f}秒\n")
+                    total_f.write(f"【OCR识别耗时】: {stats['ocr_seconds']:.1f}秒\n")
+                total_f.write(f"【回复缓存命中】: {stats['llm_cache_hits']}\n")
+                total_f.write(f"【重复作文合并请求】: {stats['llm_dedup_hits']}\n")
+                total_f.write(f"【续批跳过（已完成）】: {stats['resumed']}\n")
+                total_f.write(f"【失败（未写结果，可重新批改重试）】: {stats['failed']}\n")
+                if stats["cancelled"]:
+                    total_f.write(f"【已取消（未批改，重新批改时继续）】: {stats['cancelled']}\n")
+                total_f.write(f"【API重试次数】: {stats['retries']}\n")
+                if stats.get("ensemble_passes"):
+                    essays = stats["ensemble_essays"]
+                    # 固定次数评分的额外消耗按每篇首次评分的token数估算
+                    first_tokens = totals["prompt_tokens"] + totals["completion_tokens"] - totals["ensemble_extra_tokens"]
+                    fixed_extra = first_tokens * (self.settings.ensemble_max_passes - 1)
+                    total_f.write(f"【多次评分】: {essays}篇共评分{stats['ensemble_passes']}次，"
+                                  f"平均每篇{stats['ensemble_passes'] / essays:.1f}次，"
+                                  f"{stats.get('ensemble_escalations', 0)}篇交给{ESCALATION_MODEL}\n")
+                    total_f.write(f"【多次评分额外token数】: {totals['ensemble_extra_tokens']}"
+                                  f"（固定评分{self.settings.ensemble_max_passes}次约需{fixed_extra}）\n")
+                if stats["batch_requests"]:
+                    total_f.write(f"【合批请求数】: {stats['batch_requests']}\n")
+                    total_f.write(f"【合批失败退回逐篇】: {stats['batch_fallbacks']}\n")
+                total_f.write("\n")
+
+                csv_writer = csv.DictWriter(csv_f, fieldnames=SUMMARY_FIELDS, extrasaction="ignore")
+                csv_writer.writeheader()
+                # JSON汇总也边读边写，不把整个清单读进内存
+                json_f.write('{"run": %s, "totals": %s, "stats": %s, "essays": [' % (
+                    json.dumps(manifest.run_id), json.dumps(totals), json.dumps(stats)))
+                for i, entry in enumerate(manifest.entries()):
+                    txt_name = os.path.basename(output_paths(entry["image"], out_dir)[1])
+                    mark = "（上次运行已完成）" if entry["status"] == "skipped" else ""
+                    mark = "（批改失败）" if entry["status"] == "failed" else mark
+                    mark = "（已取消）" if entry["status"] == "cancelled" else mark
+                    usage = {"prompt_tokens": entry["prompt_tokens"], "completion_tokens": entry["completion_tokens"],
+                             "estimated": entry.get("tokens_estimated", False)}
+                    total_f.write(f"===== {txt_name} ====={mark}\n")
+                    total_f.write(format_essay_text(entry["ocr_text"], entry["result"], usage, entry["cached"],
+                                                    entry["ensemble"]))
+                    total_f.write("\n\n")
+                    csv_writer.writerow(entry)
+                    row = {k: entry[k] for k in SUMMARY_FIELDS}
+                    json_f.write(("," if i else "") + "\n  " + json.dumps(row, ensure_ascii=False))
+                json_f.write("\n]}\n")
+        except Exception as e:
+            logging.error("[汇总] 生成失败: %s", e)
+
+    def ocr_image(self, img):
+        """对已解码的图片做OCR，img可以是PIL图片或图片路径"""
+        backend = self.get_ocr_backend()
+        try:
+            if isinstance(img, str):
+                img = Image.open(img)
+            self.count("ocr_calls")
+            settings = self.settings
+            if settings.preprocess:
+                img, timings = preprocess_image(img, settings.target_dpi, settings.deskew,
+                                                settings.binarize, settings.crop_margin)
+                self.metrics.observe("preprocess", sum(timings.values()))
+            start = time.perf_counter()
+            # 自动尝试中英文混合识别
+            text = backend.image_to_string(img, OCR_LANG)
+            elapsed = time.perf_counter() - start
+            self.metrics.observe("recognize", elapsed)
+            if settings.preprocess:
+                logging.info(f"[OCR] 预处理: {format_timings(timings)}, {backend.name}识别 {elapsed:.3f}s, 尺寸 {img.size}")
+            else:
+                logging.info(f"[OCR] 未预处理, {backend.name}识别 {elapsed:.3f}s, 尺寸 {img.size}")
+            text = text.strip()
+            # 简单清洗：去除多余空行
+            text = "\n".join([line.strip() for line in text.splitlines() if line.strip()])
+            logging.debug("[OCR] 识别结果: %r", text)
+            if not text or len(text) < 10:
+                return OCR_FAILED
+            return text
+        except Exception as e:
+            logging.error("[OCR] 异常: %s", e)
+            return OCR_FAILED
+
+    def current_provider(self):
+        return "ChatGPT" if self.settings.api_type == "ChatGPT" else "DeepSeek"
+
+    def api_client_key(self):
+        provider = self.current_provider()
+        return (provider, self.settings.base_url or PROVIDER_BASE_URLS[provider], self.settings.api_key)
+
+    def get_client(self):
+        provider, base_url, api_key = self.api_client_key()
+        return get_api_client(provider, base_url, api_key, self.settings.max_concurrency)
+
+    def current_model(self):
+        if self.settings.api_type == "ChatGPT":
+            return "gpt-3.5-turbo"
+        return "deepseek-reasoner" if self.settings.deepthink else "deepseek-chat"
+
+    def ask_ai(self, prompt):
+        """直接请求大模型，返回(回复内容, usage)"""
+        content, reasoning_content, usage = self.request_completion(self.current_model(), build_messages(prompt))
+        return format_reply(content, reasoning_content), usage
+
+    def grade_single(self, record, title, criteria):
+        """单篇批改，结果写回record"""
+        prompt = grading_prompt(title, criteria, record.ocr_text)
+        name = os.path.basename(record.path)
+
+        def on_score(score):
+            record.score = score
+            self.notify(f"{name} 得分：{score}")
+
+        def on_delta(text, is_content):
+            tail = text[-80:].replace('\n', ' ')
+            state = "正在生成" if is_content else "正在思考"
+            self.notify(f"{name} {state}：{tail}")
+
+        record.result, record.usage, record.cached = self.ask_ai_cached(
+            build_messages(prompt), on_score=on_score, on_delta=on_delta
+        )
+        record.score = extract_score(record.result)
+
+    def grade_ensemble(self, record, title, criteria):
+        """多次评分：先并发评分若干次，分数一致即停止；不一致时逐次追加评分，仍不一致时交给推理模型，结果写回record"""
+        settings = self.settings
+        messages = build_messages(grading_prompt(title, criteria, record.ocr_text))
+        name = os.path.basename(record.path)
+        size = max(2, settings.ensemble_passes)
+        max_passes = max(size, settings.ensemble_max_passes)
+
+        def run_pass(index, model=None):
+            result, usage, cached = self.ask_ai_cached(messages, model=model, variant=index)
+            score = extract_score(result) if result != AI_FAILED else ""
+            return {"result": result, "score": score, "value": score_value(score), "usage": usage, "cached": cached}
+
+        passes = []
+        count = size
+        while True:
+            with ThreadPoolExecutor(max_workers=count - len(passes)) as pool:
+                passes += pool.map(run_pass, range(len(passes), count))
+            values = [p["value"] for p in passes if p["value"] is not None]
+            group = agreeing_scores(values, size, settings.ensemble_tolerance)
+            if group or count >= max_passes or self.cancelled():
+                break
+            count += 1
+            self.notify(f"{name} 各次分数不一致（{' / '.join(p['score'] or '失败' for p in passes)}），追加第{count}次评分")
+        arbiter = None
+        if (group is None and values and settings.ensemble_escalate and not self.cancelled()
+                and self.current_provider() == "DeepSeek" and self.current_model() != ESCALATION_MODEL):
+            self.notify(f"{name} 评分{len(passes)}次仍不一致，交给{ESCALATION_MODEL}评分")
+            # 与同模型的普通批改共用缓存
+            arbiter = run_pass(0, ESCALATION_MODEL)
+            self.count("ensemble_escalations")
+        all_passes = passes + ([arbiter] if arbiter else [])
+        self.count("ensemble_passes", len(all_passes))
+        self.count("ensemble_essays")
+        # 实际请求和命中缓存的评分分开统计：record.usage只计实际消耗，全部命中缓存时才记为缓存
+        requested = [p for p in all_passes if not p["cached"]]
+        hits = [p for p in all_passes if p["cached"]]
+        record.usage = sum_usage(p["usage"] for p in (requested or hits))
+        record.cached = not requested
+        if not values:
+            record.result = AI_FAILED
+            return
+        if arbiter and arbiter["value"] is not None:
+            final, chosen = arbiter["value"], arbiter
+        else:
+            final = median(group or values)
+            # 用分数最接近最终分数的那次评分的评语
+            chosen = min((p for p in passes if p["value"] is not None), key=lambda p: abs(p["value"] - final))
+        record.result = chosen["result"]
+        if chosen["value"] == final:
+            record.score = chosen["score"]
+        else:
+            record.score = SCORE_NUMBER_PATTERN.sub(format_number(final), chosen["score"], count=1)
+        # 额外消耗：除第一次外实际请求（未命中缓存）的token数
+        extra_tokens = sum(usage_tokens(p["usage"]) for p in all_passes[1:] if not p["cached"])
+        self.count("ensemble_extra_tokens", extra_tokens)
+        record.ensemble = {
+            "passes": len(all_passes),
+            "scores": [p["score"] or "失败" for p in all_passes],
+            "spread": max(values) - min(values),
+            "agreed": group is not None,
+            "tolerance": settings.ensemble_tolerance,
+            "escalated": arbiter is not None,
+            "extra_tokens": extra_tokens,
+            "cached_passes": len(hits),
+            # 部分评分命中缓存时，命中部分的用量（不计入实际消耗）
+            "cached_usage": sum_usage(p["usage"] for p in hits) if requested else None,
+        }
+
+    def grade_batch(self, records, title, criteria):
+        """多篇合批批改，解析成功返回True并把结果写回各record"""
+        essays = [(i + 1, record.ocr_text) for i, record in enumerate(records)]
+        messages = build_batch_messages(title, criteria, essays)
+        self.count("batch_requests")
+        self.notify(f"正在合批批改{len(records)}篇...")
+        reply, usage, cached = self.ask_ai_cached(messages, stop_at_score=False)
+        # 只解析正文，思维链里可能也有方括号
+        content = reply.split(REASONING_MARKER)[0]
+        parsed = parse_batch_reply(content, [essay_id for essay_id, _ in essays])
+        if parsed is None:
+            logging.error("[合批] 回复无法解析，退回逐篇批改: %r", content)
+            self.count("batch_fallbacks")
+            return False
+        for (essay_id, _), record, share in zip(essays, records, split_usage(usage, len(records))):
+            score, comment = parsed[essay_id]
+            record.result = f"<score>{score}</>\n{comment}"
+            record.score = score
+            record.usage = share
+            record.cached = cached
+        return True
+
+    def ask_ai_cached(self, messages, on_score=None, on_delta=None, stop_at_score=None, model=None, variant=0):
+        """带持久化缓存和批内去重的请求，返回(回复内容, usage, 是否来自缓存)；
+        variant区分多次评分中的各次请求，第0次与普通批改共用缓存"""
+        model = model or self.current_model()
+        if stop_at_score is None:
+            stop_at_score = self.settings.stream and self.settings.score_only
+        key_parts = [model, messages]
+        if stop_at_score:
+            # 只要分数时回复是截断的，不能和完整回复共用缓存
+            key_parts.append("score_only")
+        if variant:
+            # 相同提示词的各次评分不能命中同一条缓存或合并成一个请求
+            key_parts.append({"pass": variant})
+        key = make_cache_key(*key_parts)
+        cache = self.get_llm_cache()
+        if cache is not None:
+            hit = cache.get(key)
+            if hit is not None:
+                self.count("llm_cache_hits")
+                logging.info("[回复缓存] 命中: %s", key)
+                return format_reply(hit["content"], hit["reasoning_content"]), hit["usage"], True
+        # 同一批里相同的作文只发一次请求，其余等待第一个请求的结果
+        with self.llm_inflight_lock:
+            future = self.llm_inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.llm_inflight[key] = future
+        if not owner:
+            content, reasoning_content, usage = future.result()
+            self.count("llm_dedup_hits")
+            return format_reply(content, reasoning_content), usage, content != AI_FAILED
+        self.count("llm_requests")
+        try:
+            content, reasoning_content, usage = self.request_completion(model, messages, on_score, on_delta, stop_at_score)
+        except Exception as e:
+            content, reasoning_content, usage = AI_FAILED, None, None
+            logging.error("[回复缓存] 请求异常: %s", e)
+        future.set_result((content, reasoning_content, usage))
+        if content == AI_FAILED:
+            # 失败的结果不保留，允许后续重试
+            with self.llm_inflight_lock:
+                self.llm_inflight.pop(key, None)
+        elif cache is not None:
+            cache.put(key, {"content": content, "reasoning_content": reasoning_content, "usage": usage})
+        return format_reply(content, reasoning_content), usage, False
+
+    def request_completion(self, model, messages, on_score=None, on_delta=None, stop_at_score=False):
+        """按API类型分发请求，经过限流并对临时性错误退避重试，返回(正文, 思维链, usage)"""
+        provider = self.current_provider()
+        tag = f"[{provider}]"
+        limiter = self.get_rate_limiter()
+        max_retries = self.settings.max_retries
+        estimated = estimate_tokens("".join(m["content"] for m in messages)) + limiter.expected_completion
+        attempt = 0
+        while True:
+            if not self.wait_control():
+                return AI_FAILED, None, None
+            if self.api_gate is not None and not self.api_gate.wait():
+                # 调度已停止（如程序退出），本篇记为失败，下次续批时重试
+                return AI_FAILED, None, None
+            try:
+                # 先占用并发名额再计时，排队等待不算进请求耗时和首字节时间
+                with self.api_slots or contextlib.nullcontext():
+                    limiter.acquire(estimated)
+                    started = time.perf_counter()
+                    if provider == "ChatGPT":
+                        content, reasoning_content, usage = self.ask_chatgpt(model, messages, on_score, on_delta,
+                                                                             stop_at_score)
+                    else:
+                        content, reasoning_content, usage = self.ask_deepseek(model, messages, on_score, on_delta,
+                                                                              stop_at_score)
+            except Exception as e:
+                limiter.settle(estimated, None)
+                if self.cancelled():
+                    logging.info("%s 请求已取消: %s", tag, e)
+                    return AI_FAILED, None, None
+                if attempt >= max_retries or not is_transient_error(e):
+                    logging.error("%s 异常: %s", tag, e)
+                    return AI_FAILED, None, None
+                delay = retry_delay(attempt)
+                retry_after = get_retry_after(e)
+                if retry_after is not None:
+                    # 服务商明确要求等待时所有并发请求一起暂停；Retry-After为0或很小时仍按退避时间等待，避免立即连续重试
+                    limiter.pause(retry_after)
+                    delay = max(delay, retry_after)
+                attempt += 1
+                self.count("retries")
+                logging.warning("%s 第%d次重试，%.1f秒后重试: %s", tag, attempt, delay, e)
+                if self.control is not None:
+                    self.control.sleep(delay)
+                else:
+                    time.sleep(delay)
+                continue
+            limiter.settle(estimated, usage)
+            self.metrics.observe("request", time.perf_counter() - started)
+            if usage:
+                self.count("prompt_tokens", usage.get("prompt_tokens") or 0)
+                self.count("completion_tokens", usage.get("completion_tokens") or 0)
+            return content, reasoning_content, usage
+
+    def ask_streaming(self, tag, model, messages, on_score=None, on_delta=None, stop_at_score=False):
+        """流式请求，返回(正文, 思维链, usage)"""
+        client = self.get_client()
+        log_request_messages(tag, messages)
+        timing = start_request_timing()
+        stream = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        with self.track_request(stream):
+            content, reasoning_content, usage = read_stream(
+                stream, on_score=on_score, on_delta=on_delta, stop_at_score=stop_at_score
+            )
+        if usage is None and self.cancelled():
+            # 回复最后才有usage，没有说明是被取消中断的
+            raise RequestCancelled()
+        self.metrics.observe("ttfb", log_request_timing(tag, timing))
+        logging.info("%s 返回内容: %r", tag, content)
+        if usage:
+            logging.info("%s usage: %r", tag, usage)
+            usage = usage_to_dict(usage)
+        else:
+            # 拿到分数即中止时收不到最后的usage，按估算值计费和限流
+            usage = estimate_usage(messages, content, reasoning_content)
+            self.count("estimated_usage_requests")
+            logging.info("%s 未返回usage，估算为: %r", tag, usage)
+        if reasoning_content:
+            logging.info("%s 思维链: %r", tag, reasoning_content)
+        return content, reasoning_content, usage
+
+    def ask_chatgpt(self, model, messages, on_score=None, on_delta=None, stop_at_score=False):
+        """请求ChatGPT，异常交给request_completion处理"""
+        if self.settings.stream:
+            return self.ask_streaming("[ChatGPT]", model, messages, on_score, on_delta, stop_at_score)
+        client = self.get_client()
+        log_request_messages("[ChatGPT]", messages)
+        timing = start_request_timing()
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=False
+        )
+        self.metrics.observe("ttfb", log_request_timing("[ChatGPT]", timing))
+        logging.info("[ChatGPT] 返回内容: %r", response.choices[0].message.content)
+        usage = getattr(response, "usage", None)
+        if usage:
+            logging.info("[ChatGPT] usage: %r", usage)
+        return response.choices[0].message.content, None, usage_to_dict(usage)
+
+    def ask_deepseek(self, model, messages, on_score=None, on_delta=None, stop_at_score=False):
+        """请求DeepSeek，异常交给request_completion处理"""
+        if self.settings.stream:
+            return self.ask_streaming("[DeepSeek]", model, messages, on_score, on_delta, stop_at_score)
+        client = self.get_client()
+        log_request_messages("[DeepSeek]", messages)
+        timing = start_request_timing()
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=False
+        )
+        self.metrics.observe("ttfb", log_request_timing("[DeepSeek]", timing))
+        content = response.choices[0].message.content
+        reasoning_content = getattr(response.choices[0].message, "reasoning_content", None)
+        usage = getattr(response, "usage", None)
+        if usage:
+            logging.info("[DeepSeek] usage: %r", usage)
+        if reasoning_content:
+            logging.info("[DeepSeek] 思维链: %r", reasoning_content)
+        return content, reasoning_content, usage_to_dict(usage)
+
+    def write_result_on_image(self, record, out_dir):
+        try:
+            result = record.result
+            score_text = record.score or extract_score(result)
+            usage = record.usage
+
+            # 复用OCR阶段解码好的图片，不再重复解码；OCR缓存命中时在这里解码唯一一次
+            if record.image is not None:
+                img = record.image
+            elif record.image_data is not None:
+                img = Image.open(io.BytesIO(record.image_data))
+            else:
+                img = Image.open(record.path)
+            img = img.convert("RGB")
+
+            # 字体按路径和字号缓存，字号随图片分辨率变化
+            settings = self.settings
+            comment = short_comment(result) if settings.comment_overlay else ""
+            draw_overlay(img, score_text, comment)
+
+            img_out, txt_out = output_paths(record.path, out_dir, settings.image_format)
+            img.save(img_out, **image_save_options(img_out, settings.jpeg_quality, settings.png_compress_level))
+
+            with open(txt_out, "w", encoding="utf-8") as f:
+                f.write(format_essay_text(record.ocr_text, result, usage, record.cached, record.ensemble))
+            return True
+        except Exception as e:
+            logging.error("[写结果] P图失败 %s: %s", record.path, e)
+            return False
+
+def essay_result(path, status, score, result, usage, cached, ocr_text="", latency=None, stages=None, ensemble=None):
+    """单篇作文的结构化结果，写入运行清单，也用于命令行输出"""
+    usage = usage or {}
+    return {
+        "image": path,
+        "status": status,
+        "score": score,
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "completion_tokens": usage.get("completion_tokens"),
+        "tokens_estimated": bool(usage.get("estimated")),
+        "cached": cached,
+        "latency": round(latency, 3) if latency is not None else None,
+        "stages": {stage: round(seconds, 3) for stage, seconds in (stages or {}).items()},
+        "passes": ensemble["passes"] if ensemble else None,
+        "spread": ensemble["spread"] if ensemble else None,
+        "ensemble": ensemble,
+        "result": result,
+        "ocr_text": ocr_text,
+    }
+
+def list_images(directory):
+    """列出目录中的作文图片（不含子目录），按文件名排序"""
+    names = sorted(f for f in os.listdir(directory) if f.lower().endswith(IMAGE_EXTENSIONS))
+    return [os.path.join(directory, name) for name in names]
+
+def write_results(results, fmt, stream):
+    """把每篇结果以JSON或CSV写到stream"""
+    if fmt == "csv":
+        writer = csv.DictWriter(stream, fieldnames=SUMMARY_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(results)
+    else:
+        json.dump(results, stream, ensure_ascii=False, indent=2)
+        stream.write("\n")
+
+def load_settings(config_path):
+    """读取配置文件，文件不存在时使用默认设置；文件无法读取或格式错误时抛出OSError、configparser.Error或ValueError"""
+    config = configparser.ConfigParser()
+    if os.path.exists(config_path):
+        with open(config_path, "r", encoding="utf-8") as f:
+            config.read_file(f)
+    return config, GradingSettings.from_config(config)
+
+def cmd_grade(args):
+    """grade子命令：批改目录中的所有作文图片"""
+    try:
+        config, settings = load_settings(args.config)
+    except (OSError, configparser.Error, ValueError) as e:
+        print(f"错误：配置文件读取失败：{args.config}：{e}", file=sys.stderr)
+        return EXIT_USAGE
+    if args.api_type:
+        settings.api_type = args.api_type
+    settings.api_key = args.api_key or os.environ.get("AEG_API_KEY") or settings.api_key
+    if args.base_url:
+        settings.base_url = args.base_url
+    if args.concurrency:
+        settings.max_concurrency = max(1, args.concurrency)
+    if args.batch_size:
+        settings.batch_size = max(1, args.batch_size)
+    if args.no_stream:
+        settings.stream = False
+    if args.no_preprocess:
+        settings.preprocess = False
+    if args.ensemble:
+        settings.ensemble = True
+    if args.metrics_jsonl:
+        settings.metrics_jsonl = os.path.abspath(args.metrics_jsonl)
+    if args.metrics_prom:
+        settings.metrics_prometheus = os.path.abspath(args.metrics_prom)
+    if not (settings.tesseract_path and os.path.isfile(settings.tesseract_path)):
+        # 命令行不做耗时的磁盘扫描，只查PATH、注册表和常见安装目录
+        settings.tesseract_path = TesseractFinder().find_quick() or settings.tesseract_path
+    if not settings.api_key:
+        print("错误：未设置API密钥（--api-key、环境变量AEG_API_KEY或配置文件）", file=sys.stderr)
+        return EXIT_USAGE
+    if args.criteria_file:
+        try:
+            with open(args.criteria_file, "r", encoding="utf-8") as f:
+                criteria = f.read().strip()
+        except (OSError, ValueError) as e:
+            print(f"错误：评分标准文件读取失败：{args.criteria_file}：{e}", file=sys.stderr)
+            return EXIT_USAGE
+    else:
+        criteria = config.get("PROMPT", "criteria", fallback="").replace('\\n', '\n')
+    if not criteria:
+        print("错误：未提供评分标准（--criteria-file或配置文件）", file=sys.stderr)
+        return EXIT_USAGE
+    if not os.path.isdir(args.dir):
+        print(f"错误：目录不存在：{args.dir}", file=sys.stderr)
+        return EXIT_USAGE
+    image_paths = list_images(args.dir)
+    if not image_paths:
+        print(f"错误：目录中没有作文图片：{args.dir}", file=sys.stderr)
+        return EXIT_USAGE
+
+    def on_progress(done, total, result):
+        if not args.quiet:
+            name = os.path.basename(result["image"])
+            spread = f" 极差{format_number(result['spread'])}" if result["spread"] is not None else ""
+            print(f"[{done}/{total}] {name} {result['status']} {result['score']}{spread}", file=sys.stderr)
+
+    engine = GradingEngine(settings)
+    results, stats = engine.run(image_paths, args.title, criteria, out_dir=args.out_dir, on_progress=on_progress)
+    if not args.quiet:
+        print(format_snapshot(engine.metrics.snapshot()), file=sys.stderr)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8", newline="") as f:
+            write_results(results, args.format, f)
+    else:
+        write_results(results, args.format, sys.stdout)
+    return EXIT_FAILED if stats["failed"] else EXIT_OK
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m aeg_engine", description="英语作文自动批改（命令行，无需图形界面）")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    grade = subparsers.add_parser("grade", help="批改目录中的作文图片")
+    grade.add_argument("--dir", required=True, help="作文图片所在目录")
+    grade.add_argument("--title", required=True, help="作文题目")
+    grade.add_argument("--criteria-file", help="评分标准文本文件，默认使用配置文件中的评分标准")
+    grade.add_argument("--out-dir", help="结果目录，默认为图片目录下的“批改结果”")
+    grade.add_argument("--format", choices=["json", "csv"], default="json", help="结果输出格式")
+    grade.add_argument("--output", help="结果输出文件，默认输出到标准输出")
+    grade.add_argument("--config", default=CONFIG_FILE, help="配置文件路径")
+    grade.add_argument("--api-type", choices=["Deepseek", "ChatGPT"], help="API类型，默认使用配置文件")
+    grade.add_argument("--api-key", help="API密钥，也可用环境变量AEG_API_KEY")
+    grade.add_argument("--base-url", help="自定义接口地址（兼容OpenAI的代理或本地测试服务）")
+    grade.add_argument("--concurrency", type=int, help="API并发数")
+    grade.add_argument("--batch-size", type=int, help="每次请求批改的作文篇数")
+    grade.add_argument("--no-stream", action="store_true", help="关闭流式输出")
+    grade.add_argument("--no-preprocess", action="store_true", help="关闭OCR前的图片预处理，用于对比识别效果")
+    grade.add_argument("--ensemble", action="store_true", help="多次评分，分数一致即停止，不一致时追加评分")
+    grade.add_argument("--metrics-jsonl", help="运行中定期把指标快照追加到该JSONL文件")
+    grade.add_argument("--metrics-prom", help="运行中定期把指标写成Prometheus文本文件")
+    grade.add_argument("--quiet", action="store_true", help="不输出进度")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        filename="debug.log",
+        filemode="a",
+        format="%(asctime)s %(levelname)s: %(message)s",
+        level=logging.INFO,
+        encoding="utf-8"
+    )
+    if args.command == "grade":
+        return cmd_grade(args)
+    return EXIT_USAGE
+
+if __name__ == "__main__":
+    sys.exit(main())
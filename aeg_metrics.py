@@ -0,0 +1,188 @@
+"""批改运行指标：各阶段耗时分布、队列深度、重试、token速率和缓存命中率
+
+快照可显示在GUI进度面板，也可导出为JSONL（每隔一段时间追加一行）或Prometheus文本格式（供node_exporter的textfile收集）。
+"""
+import json
+import os
+import threading
+import time
+
+# 阶段名称：ocr/api/write为每篇作文在各流水线阶段的耗时，其余为更细的分项
+STAGE_LABELS = {
+    "ocr": "OCR",
+    "preprocess": "预处理",
+    "recognize": "识别",
+    "api": "API",
+    "request": "单次请求",
+    "ttfb": "首字节",
+    "write": "写结果",
+    "total": "单篇总计",
+}
+QUEUE_LABELS = {
+    "ocr": "待OCR",
+    "grade": "待合批",
+    "api": "待请求",
+    "write": "待写出",
+}
+# 判断瓶颈时比较的流水线阶段
+PIPELINE_STAGES = ("ocr", "api", "write")
+
+def percentile(values, p):
+    """最近秩法求百分位，values为空时返回None"""
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+def ratio(part, whole):
+    return round(part / whole, 3) if whole else None
+
+class RunMetrics:
+    """一次批改的指标，所有方法线程安全"""
+
+    def __init__(self, total=0, workers=None):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.total = total
+        # 各阶段的并发数，用来折算利用率
+        self.workers = workers or {}
+        self.counters = {}
+        self.timings = {}
+        self.gauges = {}
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            self.timings.setdefault(stage, []).append(seconds)
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def total_time(self, stage):
+        with self.lock:
+            return sum(self.timings.get(stage, ()))
+
+    def snapshot(self):
+        """当前指标的快照（可直接序列化为JSON）"""
+        with self.lock:
+            counters = dict(self.counters)
+            timings = {stage: list(values) for stage, values in self.timings.items()}
+            gauges = dict(self.gauges)
+        elapsed = time.monotonic() - self.started
+        stages = {}
+        for stage, values in timings.items():
+            total_seconds = sum(values)
+            stages[stage] = {
+                "count": len(values),
+                "sum": round(total_seconds, 3),
+                "avg": round(total_seconds / len(values), 3),
+                "p50": round(percentile(values, 50), 3),
+                "p95": round(percentile(values, 95), 3),
+                "max": round(max(values), 3),
+            }
+        # 利用率：阶段累计耗时 / (并发数 × 已运行时间)，最高的就是瓶颈
+        utilization = {}
+        for stage in PIPELINE_STAGES:
+            if stage in stages and elapsed > 0:
+                utilization[stage] = round(stages[stage]["sum"] / (self.workers.get(stage, 1) * elapsed), 3)
+        bottleneck = max(utilization, key=utilization.get) if utilization else None
+        done = counters.get("essays_done", 0)
+        # 吞吐只算本次实际处理的作文，不含续批跳过的
+        processed = done - counters.get("resumed", 0)
+        tokens = counters.get("prompt_tokens", 0) + counters.get("completion_tokens", 0)
+        llm_hits = counters.get("llm_cache_hits", 0) + counters.get("llm_dedup_hits", 0)
+        return {
+            "time": time.time(),
+            "elapsed": round(elapsed, 3),
+            "total": self.total,
+            "done": done,
+            "essays_per_minute": round(processed / elapsed * 60, 2) if elapsed > 0 else None,
+            "tokens_per_second": round(tokens / elapsed, 1) if elapsed > 0 else None,
+            "completion_tokens_per_second": round(counters.get("completion_tokens", 0) / elapsed, 1)
+            if elapsed > 0 else None,
+            "ocr_cache_hit_rate": ratio(counters.get("ocr_cache_hits", 0),
+                                        counters.get("ocr_cache_hits", 0) + counters.get("ocr_calls", 0)),
+            "llm_cache_hit_rate": ratio(llm_hits, llm_hits + counters.get("llm_requests", 0)),
+            "utilization": utilization,
+            "bottleneck": bottleneck,
+            "counters": counters,
+            "queues": gauges,
+            "stages": stages,
+        }
+
+def format_snapshot(snapshot):
+    """进度面板上显示的多行文字"""
+    lines = [f"已完成 {snapshot['done']}/{snapshot['total']}，用时 {snapshot['elapsed']:.0f}秒，"
+             f"{snapshot['essays_per_minute'] or 0:.1f} 篇/分钟，{snapshot['tokens_per_second'] or 0:.0f} token/秒"]
+    stage_texts = []
+    for stage in PIPELINE_STAGES + ("ttfb",):
+        values = snapshot["stages"].get(stage)
+        if values:
+            stage_texts.append(f"{STAGE_LABELS[stage]} 平均{values['avg']:.2f}s/p95 {values['p95']:.2f}s")
+    if stage_texts:
+        lines.append("，".join(stage_texts))
+    queues = snapshot["queues"]
+    if queues:
+        lines.append("队列：" + "，".join(f"{QUEUE_LABELS.get(name, name)} {depth}" for name, depth in queues.items()))
+    counters = snapshot["counters"]
+    hit_texts = []
+    if snapshot["ocr_cache_hit_rate"] is not None:
+        hit_texts.append(f"OCR缓存命中 {snapshot['ocr_cache_hit_rate']:.0%}")
+    if snapshot["llm_cache_hit_rate"] is not None:
+        hit_texts.append(f"回复缓存命中 {snapshot['llm_cache_hit_rate']:.0%}")
+    hit_texts.append(f"重试 {counters.get('retries', 0)}次")
+    hit_texts.append(f"失败 {counters.get('failed', 0)}篇")
+    lines.append("，".join(hit_texts))
+    if snapshot["bottleneck"]:
+        busy = "，".join(f"{STAGE_LABELS[stage]} {value:.0%}" for stage, value in snapshot["utilization"].items())
+        lines.append(f"瓶颈：{STAGE_LABELS[snapshot['bottleneck']]}（繁忙度 {busy}）")
+    return "\n".join(lines)
+
+def to_prometheus(snapshot):
+    """Prometheus文本格式"""
+    lines = [
+        "# HELP aeg_essays_total 作文数",
+        "# TYPE aeg_essays_total gauge",
+        f"aeg_essays_total {snapshot['total']}",
+        "# HELP aeg_essays_done 已完成的作文数",
+        "# TYPE aeg_essays_done gauge",
+        f"aeg_essays_done {snapshot['done']}",
+        "# TYPE aeg_elapsed_seconds gauge",
+        f"aeg_elapsed_seconds {snapshot['elapsed']}",
+        "# TYPE aeg_counter_total counter",
+    ]
+    for name, value in sorted(snapshot["counters"].items()):
+        lines.append(f'aeg_counter_total{{name="{name}"}} {value}')
+    lines.append("# TYPE aeg_queue_depth gauge")
+    for name, depth in snapshot["queues"].items():
+        lines.append(f'aeg_queue_depth{{queue="{name}"}} {depth}')
+    lines.append("# TYPE aeg_stage_utilization gauge")
+    for stage, value in snapshot["utilization"].items():
+        lines.append(f'aeg_stage_utilization{{stage="{stage}"}} {value}')
+    lines.append("# TYPE aeg_stage_seconds summary")
+    for stage, values in snapshot["stages"].items():
+        lines.append(f'aeg_stage_seconds{{stage="{stage}",quantile="0.5"}} {values["p50"]}')
+        lines.append(f'aeg_stage_seconds{{stage="{stage}",quantile="0.95"}} {values["p95"]}')
+        lines.append(f'aeg_stage_seconds_sum{{stage="{stage}"}} {values["sum"]}')
+        lines.append(f'aeg_stage_seconds_count{{stage="{stage}"}} {values["count"]}')
+    for name in ("ocr_cache_hit_rate", "llm_cache_hit_rate", "tokens_per_second"):
+        if snapshot[name] is not None:
+            lines.append(f"# TYPE aeg_{name} gauge")
+            lines.append(f"aeg_{name} {snapshot[name]}")
+    return "\n".join(lines) + "\n"
+
+def append_jsonl(path, snapshot):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(snapshot, ensure_ascii=False) + "\n")
+
+def write_prometheus(path, snapshot):
+    """先写临时文件再替换，收集器不会读到写了一半的文件"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(to_prometheus(snapshot))
+    os.replace(tmp_path, path)
@@ -0,0 +1,131 @@
+"""OCR后端：统一的识别接口和注册表，默认优先用常驻内存的tesserocr，没有安装时退回pytesseract
+
+新的本地OCR引擎继承OCRBackend，实现image_to_string和version，再用register_backend注册即可在配置中选用。
+"""
+import logging
+import os
+import queue
+import threading
+import pytesseract
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+DEFAULT_OCR_BACKEND = "auto"
+
+class OCRBackend:
+    """OCR后端接口：同一个实例会被多个OCR线程同时调用，实现需要线程安全"""
+    name = ""
+
+    def __init__(self, tesseract_path=None):
+        self.tesseract_path = tesseract_path
+
+    def version(self):
+        """识别引擎版本，写进OCR缓存键，升级引擎后旧缓存自动失效"""
+        raise NotImplementedError
+
+    def image_to_string(self, img, lang):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class PytesseractBackend(OCRBackend):
+    """每张图片启动一次tesseract进程，并重新加载语言模型"""
+    name = "pytesseract"
+
+    def __init__(self, tesseract_path=None):
+        super().__init__(tesseract_path)
+        if tesseract_path and os.path.exists(tesseract_path):
+            pytesseract.pytesseract.tesseract_cmd = tesseract_path
+
+    def version(self):
+        return str(pytesseract.get_tesseract_version())
+
+    def image_to_string(self, img, lang):
+        return pytesseract.image_to_string(img, lang=lang)
+
+class TesserocrBackend(OCRBackend):
+    """通过tesserocr直接调用Tesseract库，语言模型加载后常驻内存，在图片之间复用
+
+    每个识别器同一时刻只能被一个线程使用，空闲的识别器放回池中，下次批改继续使用。
+    """
+    name = "tesserocr"
+
+    def __init__(self, tesseract_path=None):
+        if tesserocr is None:
+            raise RuntimeError("未安装tesserocr（pip install tesserocr）")
+        super().__init__(tesseract_path)
+        self.tessdata = None
+        # Windows上没有设置TESSDATA_PREFIX时，使用tesseract.exe旁边的tessdata目录
+        if tesseract_path:
+            tessdata = os.path.join(os.path.dirname(tesseract_path), "tessdata")
+            if os.path.isdir(tessdata):
+                self.tessdata = tessdata
+        # 按语言分组的空闲识别器
+        self.idle = {}
+        self.apis = []
+        self.lock = threading.Lock()
+
+    def version(self):
+        return tesserocr.tesseract_version().splitlines()[0]
+
+    def idle_queue(self, lang):
+        with self.lock:
+            return self.idle.setdefault(lang, queue.LifoQueue())
+
+    def acquire(self, lang):
+        try:
+            return self.idle_queue(lang).get_nowait()
+        except queue.Empty:
+            pass
+        kwargs = {"lang": lang}
+        if self.tessdata:
+            kwargs["path"] = self.tessdata
+        api = tesserocr.PyTessBaseAPI(**kwargs)
+        with self.lock:
+            self.apis.append(api)
+            count = len(self.apis)
+        logging.info(f"[OCR] 加载tesserocr识别器（语言 {lang}），当前共 {count} 个")
+        return api
+
+    def image_to_string(self, img, lang):
+        api = self.acquire(lang)
+        try:
+            api.SetImage(img)
+            return api.GetUTF8Text()
+        finally:
+            api.Clear()
+            self.idle_queue(lang).put(api)
+
+    def close(self):
+        with self.lock:
+            apis, self.apis = self.apis, []
+            self.idle = {}
+        for api in apis:
+            api.End()
+
+OCR_BACKENDS = {}
+
+def register_backend(name, factory):
+    """注册OCR后端，factory接收tesseract_path参数并返回OCRBackend实例"""
+    OCR_BACKENDS[name] = factory
+
+register_backend(PytesseractBackend.name, PytesseractBackend)
+register_backend(TesserocrBackend.name, TesserocrBackend)
+
+def create_backend(name=DEFAULT_OCR_BACKEND, tesseract_path=None):
+    """按名称创建OCR后端；auto优先用tesserocr，不可用或创建失败时退回pytesseract"""
+    if name == DEFAULT_OCR_BACKEND:
+        name = TesserocrBackend.name if tesserocr is not None else PytesseractBackend.name
+    factory = OCR_BACKENDS.get(name)
+    if factory is None:
+        logging.warning(f"[OCR] 未知的后端 {name}，改用pytesseract")
+        return PytesseractBackend(tesseract_path)
+    try:
+        return factory(tesseract_path)
+    except Exception as e:
+        logging.warning(f"[OCR] 后端 {name} 初始化失败，改用pytesseract: {e}")
+        return PytesseractBackend(tesseract_path)
@@ -0,0 +1,118 @@
+"""OCR前的图片预处理：灰度、按目标DPI缩小、纠偏、自适应二值化、裁边
+
+全部用Pillow的整图运算（滤波、查表、缩放求均值）完成，不逐像素循环，也不需要额外依赖。
+"""
+import time
+from PIL import Image, ImageChops, ImageFilter, ImageOps, ImageStat
+
+# 预处理算法变化时修改版本号，让旧的OCR缓存失效
+PREPROCESS_VERSION = 1
+# 手机拍照没有可靠的DPI信息，按A4纸长边（11.69英寸）估算
+A4_LONG_SIDE_INCH = 11.69
+DEFAULT_TARGET_DPI = 300
+# 纠偏只在±5度内搜索，先粗后细
+DESKEW_MAX_ANGLE = 5.0
+DESKEW_COARSE_STEP = 1.0
+DESKEW_FINE_STEP = 0.2
+# 估计倾斜角度时用的缩略图长边
+DESKEW_SAMPLE_SIZE = 1000
+# 二值化窗口约为图片宽度的1/40，比局部均值暗超过该值的像素视为字迹
+BINARIZE_WINDOW_RATIO = 1 / 40
+BINARIZE_OFFSET = 10
+# 裁边：字迹像素占比低于该值的行/列视为空白，裁剪后保留的边距（像素）
+CROP_INK_RATIO = 0.005
+CROP_PADDING = 20
+
+STAGE_NAMES = {
+    "grayscale": "灰度",
+    "downscale": "缩小",
+    "deskew": "纠偏",
+    "binarize": "二值化",
+    "crop": "裁边",
+}
+
+def downscale(img, target_dpi):
+    """按A4纸估算图片DPI，高于目标DPI时等比缩小"""
+    dpi = max(img.size) / A4_LONG_SIDE_INCH
+    if dpi <= target_dpi * 1.05:
+        return img
+    ratio = target_dpi / dpi
+    size = (max(1, round(img.width * ratio)), max(1, round(img.height * ratio)))
+    return img.resize(size, Image.BILINEAR, reducing_gap=2.0)
+
+def binarize(gray):
+    """自适应二值化：与窗口内均值比较，光照不均的照片也能分开字迹和纸面"""
+    radius = max(3, int(gray.width * BINARIZE_WINDOW_RATIO) // 2)
+    mean = gray.filter(ImageFilter.BoxBlur(radius))
+    # 局部均值比像素亮多少，亮得多的就是字迹
+    diff = ImageChops.subtract(mean, gray)
+    return diff.point(lambda v: 0 if v > BINARIZE_OFFSET else 255)
+
+def ink_profile(ink, axis):
+    """每行（axis=0）或每列（axis=1）的字迹占比，用BOX缩放一次算出"""
+    if axis == 0:
+        profile = ink.resize((1, ink.height), Image.BOX)
+    else:
+        profile = ink.resize((ink.width, 1), Image.BOX)
+    return [v / 255 for v in profile.getdata()]
+
+def frange(start, stop, step):
+    count = int(round((stop - start) / step))
+    return [start + i * step for i in range(count + 1)]
+
+def estimate_skew(gray):
+    """投影法估计倾斜角度：转到正确角度时各行字迹占比的方差最大"""
+    sample = gray.copy()
+    sample.thumbnail((DESKEW_SAMPLE_SIZE, DESKEW_SAMPLE_SIZE))
+    ink = ImageOps.invert(binarize(sample))
+
+    def score(angle):
+        rotated = ink.rotate(angle, resample=Image.NEAREST)
+        return ImageStat.Stat(rotated.resize((1, rotated.height), Image.BOX)).var[0]
+
+    best = max(frange(-DESKEW_MAX_ANGLE, DESKEW_MAX_ANGLE, DESKEW_COARSE_STEP), key=score)
+    return max(frange(best - DESKEW_COARSE_STEP, best + DESKEW_COARSE_STEP, DESKEW_FINE_STEP), key=score)
+
+def deskew(gray):
+    angle = estimate_skew(gray)
+    if abs(angle) < DESKEW_FINE_STEP / 2:
+        return gray
+    # 转出来的角落用纸面颜色（中位灰度）填充，避免二值化时在边界产生假字迹
+    paper = int(ImageStat.Stat(gray).median[0])
+    return gray.rotate(angle, resample=Image.BILINEAR, expand=True, fillcolor=paper)
+
+def crop_margin(img, binary=None):
+    """裁掉四周没有字迹的空白，binary为已二值化的图片，没有则临时计算"""
+    ink = ImageOps.invert(binary if binary is not None else binarize(img))
+    rows = [i for i, v in enumerate(ink_profile(ink, 0)) if v > CROP_INK_RATIO]
+    cols = [i for i, v in enumerate(ink_profile(ink, 1)) if v > CROP_INK_RATIO]
+    if not rows or not cols:
+        return img
+    box = (max(0, cols[0] - CROP_PADDING), max(0, rows[0] - CROP_PADDING),
+           min(img.width, cols[-1] + 1 + CROP_PADDING), min(img.height, rows[-1] + 1 + CROP_PADDING))
+    return img.crop(box)
+
+def preprocess_image(img, target_dpi=DEFAULT_TARGET_DPI, do_deskew=True, do_binarize=True, do_crop=True):
+    """依次执行各预处理步骤，返回(处理后的图片, 各步骤耗时秒数)"""
+    timings = {}
+
+    def timed(stage, func, *args):
+        start = time.perf_counter()
+        value = func(*args)
+        timings[stage] = time.perf_counter() - start
+        return value
+
+    img = timed("grayscale", lambda i: i if i.mode == "L" else i.convert("L"), img)
+    if target_dpi:
+        img = timed("downscale", downscale, img, target_dpi)
+    if do_deskew:
+        img = timed("deskew", deskew, img)
+    binary = None
+    if do_binarize:
+        binary = img = timed("binarize", binarize, img)
+    if do_crop:
+        img = timed("crop", crop_margin, img, binary)
+    return img, timings
+
+def format_timings(timings):
+    return ", ".join(f"{STAGE_NAMES[stage]} {seconds:.3f}s" for stage, seconds in timings.items())
@@ -0,0 +1,401 @@
+"""省钱模式的任务队列和调度：白天先做OCR，优惠时段内才发API请求，时段结束自动暂停、次日继续
+
+任务队列保存在配置文件旁的aeg_jobs.json中，程序重启后未完成的任务会继续调度；
+每篇作文的进度由批改结果目录下的任务日志记录，重新调度时只处理未完成的部分。
+"""
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from aeg_controller import RunControl
+from aeg_engine import CONFIG_FILE, GradingEngine, load_settings
+
+JOBS_FILE = os.path.join(os.path.dirname(os.path.abspath(CONFIG_FILE)), "aeg_jobs.json")
+# DeepSeek的优惠时段为北京时间00:30-08:30
+DEFAULT_WINDOW_START = "00:30"
+DEFAULT_WINDOW_END = "08:30"
+DEFAULT_UTC_OFFSET = 8
+# 没有历史数据时，按每篇作文API耗时和token数估算
+DEFAULT_ESSAY_API_SECONDS = 30.0
+DEFAULT_ESSAY_TOKENS = 1500
+# 用最近多少次运行的数据估算
+HISTORY_SIZE = 20
+# 等待时最长隔多久检查一次时间，电脑休眠或调整时钟后也能及时醒来
+MAX_WAIT_SECONDS = 60
+# 界面上正在手动批改时，隔多久检查一次能否开始任务
+HOLD_CHECK_SECONDS = 1.0
+
+class SchedulerStopped(Exception):
+    pass
+
+def parse_hhmm(text):
+    hour, minute = text.strip().split(":")
+    return datetime.time(int(hour), int(minute))
+
+class DiscountWindow:
+    """每天的优惠时段，按服务商所在时区计算，支持跨零点的时段"""
+
+    def __init__(self, start=DEFAULT_WINDOW_START, end=DEFAULT_WINDOW_END, utc_offset=DEFAULT_UTC_OFFSET):
+        self.start = parse_hhmm(start)
+        self.end = parse_hhmm(end)
+        self.tz = datetime.timezone(datetime.timedelta(hours=utc_offset))
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config.get("SCHEDULE", "start", fallback=DEFAULT_WINDOW_START),
+            config.get("SCHEDULE", "end", fallback=DEFAULT_WINDOW_END),
+            config.getfloat("SCHEDULE", "utc_offset", fallback=DEFAULT_UTC_OFFSET),
+        )
+
+    def now(self):
+        return datetime.datetime.now(self.tz)
+
+    def is_open(self, now=None):
+        t = (now or self.now()).timetz().replace(tzinfo=None)
+        if self.start <= self.end:
+            return self.start <= t < self.end
+        return t >= self.start or t < self.end
+
+    def next_start(self, now=None):
+        """下一个时段的开始时间（已在时段内时返回下一天的开始）"""
+        now = now or self.now()
+        start = now.replace(hour=self.start.hour, minute=self.start.minute, second=0, microsecond=0)
+        return start if start > now else start + datetime.timedelta(days=1)
+
+    def current_end(self, now=None):
+        """当前时段的结束时间，不在时段内时返回None"""
+        now = now or self.now()
+        if not self.is_open(now):
+            return None
+        end = now.replace(hour=self.end.hour, minute=self.end.minute, second=0, microsecond=0)
+        return end if end > now else end + datetime.timedelta(days=1)
+
+    def describe(self):
+        offset = self.tz.utcoffset(None).total_seconds() / 3600
+        return f"{self.start.strftime('%H:%M')}-{self.end.strftime('%H:%M')}（UTC{offset:+g}）"
+
+    def local_text(self, dt):
+        """换算成本机时间显示"""
+        return dt.astimezone().strftime("%Y-%m-%d %H:%M")
+
+class WindowGate:
+    """API请求前调用wait()：不在优惠时段就阻塞到下一个时段开始，stop_event被设置（任务取消或调度停止）时返回False"""
+
+    def __init__(self, window, stop_event, on_pause=None, on_resume=None):
+        self.window = window
+        self.stop_event = stop_event
+        self.on_pause = on_pause
+        self.on_resume = on_resume
+        self.lock = threading.Lock()
+        self.paused = False
+
+    def wait(self):
+        while not self.window.is_open():
+            with self.lock:
+                first = not self.paused
+                self.paused = True
+            next_start = self.window.next_start()
+            if first and self.on_pause:
+                self.on_pause(next_start)
+            seconds = (next_start - self.window.now()).total_seconds()
+            if self.stop_event.wait(min(MAX_WAIT_SECONDS, max(1.0, seconds))):
+                return False
+        with self.lock:
+            resumed = self.paused
+            self.paused = False
+        if resumed and self.on_resume:
+            self.on_resume()
+        return True
+
+class JobQueue:
+    """持久化的省钱模式任务队列和历次运行的耗时记录"""
+
+    def __init__(self, path=JOBS_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.jobs = []
+        self.history = []
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self.jobs = data.get("jobs", [])
+                self.history = data.get("history", [])
+            except Exception as e:
+                logging.error("[省钱模式] 读取任务队列失败: %s", e)
+
+    def save(self):
+        # 先写临时文件再替换，中途退出也不会损坏队列
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"jobs": self.jobs, "history": self.history}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def add(self, image_paths, title, criteria, out_dir):
+        job = {
+            "id": uuid.uuid4().hex[:8],
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "image_paths": list(image_paths),
+            "title": title,
+            "criteria": criteria,
+            "out_dir": out_dir,
+            "state": "queued",
+        }
+        with self.lock:
+            self.jobs.append(job)
+            self.save()
+        return job
+
+    def update(self, job, **fields):
+        with self.lock:
+            job.update(fields)
+            self.save()
+
+    def pending(self):
+        """未完成的任务（queued/ocr_done/running），上次运行中被中断的也算；用户取消的不算"""
+        with self.lock:
+            return [job for job in self.jobs if job["state"] not in ("done", "failed", "cancelled")]
+
+    def record_history(self, essays, api_seconds, tokens, concurrency):
+        if essays <= 0:
+            return
+        with self.lock:
+            self.history.append({"essays": essays, "api_seconds": api_seconds, "tokens": tokens,
+                                 "concurrency": concurrency})
+            self.history = self.history[-HISTORY_SIZE:]
+            self.save()
+
+    def estimate_minutes(self, essays, concurrency, tpm=0):
+        """按历史数据估算批改essays篇需要的分钟数：API耗时按并发数折算，设置了TPM时不少于按token数算出的时间"""
+        with self.lock:
+            history = list(self.history)
+        total = sum(h["essays"] for h in history)
+        if total:
+            # 历史记录中的API耗时是各并发线程的累计耗时，先折算成单篇耗时
+            seconds_per_essay = sum(h["api_seconds"] for h in history) / total
+            tokens_per_essay = sum(h["tokens"] for h in history) / total
+        else:
+            seconds_per_essay = DEFAULT_ESSAY_API_SECONDS
+            tokens_per_essay = DEFAULT_ESSAY_TOKENS
+        minutes = essays * seconds_per_essay / max(1, concurrency) / 60
+        if tpm:
+            minutes = max(minutes, essays * tokens_per_essay / tpm)
+        return minutes
+
+def record_run_history(job_queue, metrics_snapshot, concurrency):
+    """把一次批改的API耗时和token数记入历史，供估算使用（手动批改也可以记录）"""
+    api = metrics_snapshot["stages"].get("api")
+    if not api:
+        return
+    counters = metrics_snapshot["counters"]
+    tokens = counters.get("prompt_tokens", 0) + counters.get("completion_tokens", 0)
+    job_queue.record_history(api["count"], api["sum"], tokens, concurrency)
+
+class OffPeakScheduler:
+    """后台调度线程：先为所有排队任务做OCR，再在优惠时段内逐个批改；时段结束时API请求暂停到下一晚
+
+    回调在调度线程中调用。hold()返回True时（如界面上正在手动批改）暂不开始任务的OCR或批改，
+    避免同一批图片被同时批改两次；正在进行的任务可以像手动批改一样暂停、继续和取消。
+    """
+
+    def __init__(self, job_queue, config_path=CONFIG_FILE, on_event=None, on_job_done=None, hold=None):
+        self.job_queue = job_queue
+        self.config_path = config_path
+        self.on_event = on_event
+        self.on_job_done = on_job_done
+        self.hold = hold
+        self.wakeup = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        # 正在OCR或批改的任务及其暂停/取消状态
+        self.active = None
+        self.control = None
+
+    @property
+    def busy(self):
+        """正在为某个任务做OCR或批改（包括批改中途等待下一个优惠时段）"""
+        with self.lock:
+            return self.active is not None
+
+    @property
+    def paused(self):
+        control = self.control
+        return control is not None and control.paused
+
+    def pause(self):
+        control = self.control
+        if control is not None:
+            control.pause()
+
+    def resume(self):
+        control = self.control
+        if control is not None:
+            control.resume()
+
+    def cancel(self):
+        """取消正在进行的任务，任务移出队列；已完成的作文保留，再次批改同一批图片时继续"""
+        control = self.control
+        if control is not None:
+            control.cancel()
+
+    def load(self):
+        """每次开始任务时重新读取配置，用户在等待期间修改的API密钥、优惠时段等也能生效"""
+        config, settings = load_settings(self.config_path)
+        return settings, DiscountWindow.from_config(config)
+
+    def notify(self, text):
+        logging.info("[省钱模式] %s", text)
+        if self.on_event:
+            self.on_event(text)
+
+    def start(self):
+        # 调度线程意外退出后，再次提交任务或启动时重新开始
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.loop, name="省钱模式调度", daemon=True)
+            self.thread.start()
+
+    def submit(self, image_paths, title, criteria, out_dir):
+        job = self.job_queue.add(image_paths, title, criteria, out_dir)
+        self.start()
+        self.wakeup.set()
+        return job
+
+    def stop(self):
+        self.stop_event.set()
+        self.wakeup.set()
+        # 中断进行中的请求；任务保持原状态，下次启动后继续
+        control = self.control
+        if control is not None:
+            control.cancel()
+
+    def sleep(self, seconds):
+        """可被新任务或退出打断的等待"""
+        self.wakeup.wait(seconds)
+        self.wakeup.clear()
+        if self.stop_event.is_set():
+            raise SchedulerStopped()
+
+    def loop(self):
+        try:
+            while True:
+                jobs = self.job_queue.pending()
+                if not jobs:
+                    self.sleep(MAX_WAIT_SECONDS)
+                    continue
+                # 白天先把所有任务的OCR做完，夜间只剩API请求
+                for job in jobs:
+                    if job["state"] == "queued":
+                        self.try_job(job, "OCR", self.prefetch_ocr, job)
+                jobs = self.job_queue.pending()
+                if not jobs:
+                    continue
+                _, window = self.load()
+                if not window.is_open():
+                    next_start = window.next_start()
+                    self.notify(f"OCR已完成，等待优惠时段 {window.local_text(next_start)} 开始批改"
+                                f"（{len(jobs)}个任务）")
+                    while not window.is_open():
+                        self.sleep(min(MAX_WAIT_SECONDS, max(1.0, (next_start - window.now()).total_seconds())))
+                        if self.job_queue.pending() != jobs:
+                            break
+                    if not window.is_open():
+                        # 等待期间有新任务，先去做它的OCR
+                        continue
+                self.try_job(jobs[0], "批改", self.run_job, jobs[0], window)
+        except SchedulerStopped:
+            pass
+        except Exception:
+            logging.exception("[省钱模式] 调度异常")
+
+    def try_job(self, job, stage, func, *args):
+        """运行任务的一个阶段；单个任务出错（如结果目录无法创建）时标记为失败并跳过，不影响后面的任务"""
+        self.begin(job)
+        try:
+            func(*args)
+        except SchedulerStopped:
+            raise
+        except Exception as e:
+            self.job_queue.update(job, state="failed", error=str(e))
+            self.notify(f"任务{job['id']}：{stage}出错，已跳过: {e}")
+            logging.exception("[省钱模式] 任务%s出错", stage)
+        finally:
+            with self.lock:
+                self.active = None
+                self.control = None
+
+    def begin(self, job):
+        """等到hold()不再阻止后把job登记为进行中，返回时已可开始"""
+        while True:
+            with self.lock:
+                self.active = job
+                self.control = RunControl()
+            # 先登记再检查，界面看到busy后不会再开始手动批改
+            if not (self.hold and self.hold()):
+                return
+            with self.lock:
+                self.active = None
+                self.control = None
+            self.sleep(HOLD_CHECK_SECONDS)
+
+    def finish_cancelled(self, job, stage):
+        """任务被用户取消时移出队列，返回是否已取消"""
+        if not self.control.cancelled or self.stop_event.is_set():
+            return False
+        self.job_queue.update(job, state="cancelled")
+        self.notify(f"任务{job['id']}：{stage}已取消，任务已移出队列；再次批改同一批图片时从未完成的部分继续")
+        return True
+
+    def prefetch_ocr(self, job):
+        engine = GradingEngine(self.load()[0])
+        total = len(job["image_paths"])
+        self.notify(f"任务{job['id']}：提前识别 {total} 张图片...")
+        engine.control = self.control
+        engine.run(job["image_paths"], job["title"], job["criteria"], out_dir=job["out_dir"], ocr_only=True)
+        if self.stop_event.is_set():
+            raise SchedulerStopped()
+        if not self.finish_cancelled(job, "OCR"):
+            self.job_queue.update(job, state="ocr_done")
+
+    def run_job(self, job, window):
+        settings, _ = self.load()
+        engine = GradingEngine(settings)
+        essays = len(job["image_paths"])
+        needed = self.job_queue.estimate_minutes(essays, settings.max_concurrency, settings.tpm)
+        end = window.current_end()
+        left = (end - window.now()).total_seconds() / 60 if end else 0
+        if needed <= left:
+            self.notify(f"任务{job['id']}：开始批改 {essays} 篇，预计{needed:.0f}分钟，本时段剩余{left:.0f}分钟")
+        else:
+            fit = int(essays * left / needed) if needed else essays
+            self.notify(f"任务{job['id']}：开始批改 {essays} 篇，预计{needed:.0f}分钟，本时段剩余{left:.0f}分钟，"
+                        f"约{essays - fit}篇将在时段结束后暂停，下一个优惠时段继续")
+
+        def on_pause(next_start):
+            self.notify(f"任务{job['id']}：优惠时段已结束，暂停到 {window.local_text(next_start)} 继续")
+
+        def on_resume():
+            self.notify(f"任务{job['id']}：进入优惠时段，继续批改")
+
+        # 取消或调度停止时，等待优惠时段的请求也立即结束
+        engine.control = self.control
+        engine.api_gate = WindowGate(window, self.control.cancel_event, on_pause, on_resume)
+        self.job_queue.update(job, state="running")
+        started = time.monotonic()
+        results, stats = engine.run(job["image_paths"], job["title"], job["criteria"], out_dir=job["out_dir"])
+        if self.stop_event.is_set():
+            # 程序退出时中断的任务保持running状态，下次启动后继续
+            raise SchedulerStopped()
+        if self.finish_cancelled(job, "批改"):
+            return
+        record_run_history(self.job_queue, engine.metrics.snapshot(), settings.max_concurrency)
+        self.job_queue.update(job, state="done", finished=datetime.datetime.now().isoformat(timespec="seconds"),
+                              failed=stats["failed"])
+        self.notify(f"任务{job['id']}：批改完成，用时{(time.monotonic() - started) / 60:.0f}分钟，失败{stats['failed']}篇")
+        if self.on_job_done:
+            self.on_job_done(job, stats)
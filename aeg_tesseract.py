@@ -0,0 +1,223 @@
+"""查找Tesseract-OCR：先查PATH、常见安装目录和注册表，都没有时才在后台有限度地扫描磁盘
+
+文件系统、环境变量和注册表的访问都通过TesseractFinder的fs参数注入，可以在Linux上用假的文件系统模拟Windows。
+"""
+import logging
+import ntpath
+import os
+import posixpath
+import string
+import sys
+import threading
+import time
+from collections import deque
+
+# 后台扫描的上限：目录数、深度和时间，超出后停止，避免在大硬盘上扫描几分钟
+SCAN_MAX_DIRS = 200000
+SCAN_MAX_DEPTH = 6
+SCAN_TIMEOUT = 120
+# 每扫描多少个目录报告一次进度
+SCAN_PROGRESS_EVERY = 500
+# 扫描时跳过的目录（小写），这些目录很大且不会装Tesseract
+SCAN_SKIP_DIRS = {
+    "windows", "$recycle.bin", "system volume information", "recovery", "$windows.~bt", "$windows.~ws",
+    "node_modules", ".git", "__pycache__", "temp", "tmp", "proc", "sys", "dev",
+}
+# Windows常见安装位置（相对于各环境变量）
+WINDOWS_KNOWN_DIRS = [
+    ("ProgramFiles", "Tesseract-OCR"),
+    ("ProgramFiles(x86)", "Tesseract-OCR"),
+    ("ProgramW6432", "Tesseract-OCR"),
+    ("LOCALAPPDATA", "Programs\\Tesseract-OCR"),
+    ("LOCALAPPDATA", "Tesseract-OCR"),
+    ("USERPROFILE", "scoop\\apps\\tesseract\\current"),
+    ("ChocolateyInstall", "bin"),
+    ("ProgramData", "chocolatey\\bin"),
+]
+WINDOWS_FALLBACK_DIRS = ["C:\\Program Files\\Tesseract-OCR", "C:\\Program Files (x86)\\Tesseract-OCR"]
+POSIX_KNOWN_DIRS = ["/usr/bin", "/usr/local/bin", "/opt/homebrew/bin", "/opt/local/bin", "/snap/bin"]
+# UB Mannheim安装包写入的注册表项
+REGISTRY_KEYS = [
+    ("HKEY_LOCAL_MACHINE", "SOFTWARE\\Tesseract-OCR", "InstallDir"),
+    ("HKEY_LOCAL_MACHINE", "SOFTWARE\\WOW6432Node\\Tesseract-OCR", "InstallDir"),
+    ("HKEY_CURRENT_USER", "SOFTWARE\\Tesseract-OCR", "InstallDir"),
+]
+
+class LocalFileSystem:
+    """真实的文件系统、环境变量和注册表"""
+
+    def is_file(self, path):
+        return os.path.isfile(path)
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def list_dirs(self, path):
+        """path下的子目录名，无权限等错误时返回空列表"""
+        try:
+            with os.scandir(path) as entries:
+                return [entry.name for entry in entries if entry.is_dir(follow_symlinks=False)]
+        except OSError:
+            return []
+
+    def getenv(self, name):
+        return os.environ.get(name)
+
+    def registry_value(self, hive, key, name):
+        try:
+            import winreg
+        except ImportError:
+            return None
+        try:
+            with winreg.OpenKey(getattr(winreg, hive), key) as handle:
+                return winreg.QueryValueEx(handle, name)[0]
+        except OSError:
+            return None
+
+    def drives(self):
+        return [f"{letter}:\\" for letter in string.ascii_uppercase if os.path.isdir(f"{letter}:\\")]
+
+class TesseractFinder:
+    def __init__(self, fs=None, windows=None):
+        self.fs = fs or LocalFileSystem()
+        self.windows = sys.platform.startswith("win") if windows is None else windows
+        self.path = ntpath if self.windows else posixpath
+        self.exe_name = "tesseract.exe" if self.windows else "tesseract"
+
+    def stamp(self, path):
+        """可执行文件的校验戳（大小和修改时间），文件不存在时返回None"""
+        try:
+            st = self.fs.stat(path)
+        except OSError:
+            return None
+        return f"{st.st_size}:{st.st_mtime_ns}"
+
+    def check_cached(self, path, stamp=None):
+        """配置中保存的路径仍然有效时返回(路径, 当前校验戳)，否则返回(None, None)
+
+        校验戳不同说明原位置重新安装或升级过，路径仍可用，但调用方应更新保存的校验戳。
+        """
+        if not path or not self.fs.is_file(path):
+            return None, None
+        current = self.stamp(path)
+        if stamp and current != stamp:
+            logging.info(f"[Tesseract] {path} 已更新（校验戳 {stamp} -> {current}）")
+        return path, current
+
+    def path_dirs(self):
+        value = self.fs.getenv("PATH") or ""
+        separator = ";" if self.windows else ":"
+        return [d.strip('"') for d in value.split(separator) if d.strip()]
+
+    def known_dirs(self):
+        if not self.windows:
+            return list(POSIX_KNOWN_DIRS)
+        dirs = []
+        for env_name, sub_dir in WINDOWS_KNOWN_DIRS:
+            base = self.fs.getenv(env_name)
+            if base:
+                dirs.append(self.path.join(base, sub_dir))
+        return dirs + WINDOWS_FALLBACK_DIRS
+
+    def registry_dirs(self):
+        if not self.windows:
+            return []
+        dirs = []
+        for hive, key, name in REGISTRY_KEYS:
+            value = self.fs.registry_value(hive, key, name)
+            if value:
+                dirs.append(value)
+        return dirs
+
+    def find_quick(self):
+        """依次检查PATH、注册表和常见安装目录，只判断少量固定路径，不会超过一秒"""
+        seen = set()
+        for source, dirs in (("PATH", self.path_dirs()), ("注册表", self.registry_dirs()),
+                             ("常见安装目录", self.known_dirs())):
+            for d in dirs:
+                candidate = self.path.join(d, self.exe_name)
+                key = candidate.lower() if self.windows else candidate
+                if key in seen:
+                    continue
+                seen.add(key)
+                if self.fs.is_file(candidate):
+                    logging.info(f"[Tesseract] 在{source}中找到 {candidate}")
+                    return candidate
+        return None
+
+    def scan_roots(self):
+        """后台扫描的起点：先扫各盘的Program Files和用户目录，再扫整个盘"""
+        if not self.windows:
+            return ["/opt", "/usr", self.fs.getenv("HOME") or "/root"]
+        drives = self.fs.drives()
+        roots = []
+        for drive in drives:
+            roots += [self.path.join(drive, "Program Files"), self.path.join(drive, "Program Files (x86)")]
+        user = self.fs.getenv("USERPROFILE")
+        if user:
+            roots.append(user)
+        return roots + drives
+
+    def scan(self, stop_event=None, on_progress=None, max_dirs=SCAN_MAX_DIRS, max_depth=SCAN_MAX_DEPTH,
+             timeout=SCAN_TIMEOUT):
+        """广度优先扫描磁盘，浅层目录先扫；超过目录数、深度或时间上限，或stop_event被设置时返回None
+
+        on_progress(已扫描目录数, 当前目录)每隔SCAN_PROGRESS_EVERY个目录调用一次。
+        """
+        started = time.monotonic()
+        visited = set()
+        pending = deque((root, 0) for root in self.scan_roots())
+        scanned = 0
+        while pending:
+            if stop_event is not None and stop_event.is_set():
+                logging.info(f"[Tesseract] 扫描已取消，已扫描 {scanned} 个目录")
+                return None
+            if scanned >= max_dirs or time.monotonic() - started > timeout:
+                logging.info(f"[Tesseract] 扫描达到上限，已扫描 {scanned} 个目录，用时 {time.monotonic() - started:.1f}s")
+                return None
+            directory, depth = pending.popleft()
+            key = directory.lower() if self.windows else directory
+            if key in visited:
+                continue
+            visited.add(key)
+            scanned += 1
+            if on_progress and scanned % SCAN_PROGRESS_EVERY == 0:
+                on_progress(scanned, directory)
+            candidate = self.path.join(directory, self.exe_name)
+            if self.fs.is_file(candidate):
+                logging.info(f"[Tesseract] 扫描 {scanned} 个目录后找到 {candidate}，"
+                             f"用时 {time.monotonic() - started:.1f}s")
+                return candidate
+            if depth >= max_depth:
+                continue
+            for name in self.fs.list_dirs(directory):
+                if name.lower() not in SCAN_SKIP_DIRS:
+                    pending.append((self.path.join(directory, name), depth + 1))
+        logging.info(f"[Tesseract] 扫描完 {scanned} 个目录，未找到")
+        return None
+
+class TesseractScan:
+    """在后台线程中运行TesseractFinder.scan，可随时取消；回调在扫描线程中调用"""
+
+    def __init__(self, finder, on_progress=None, on_done=None):
+        self.finder = finder
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="查找Tesseract", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.stop_event.set()
+
+    def run(self):
+        try:
+            found = self.finder.scan(self.stop_event, self.on_progress)
+        except Exception as e:
+            logging.error(f"[Tesseract] 扫描出错: {e}")
+            found = None
+        if self.on_done:
+            self.on_done(found, self.stop_event.is_set())
@@ -2,27 +2,30 @@ import tkinter as tk
 from tkinter import filedialog, messagebox, simpledialog, ttk
 import configparser
 import os
-from PIL import Image, ImageDraw, ImageFont
 import pytesseract
 import requests
-import threading
 import sys
-import datetime
 import shutil
 import webbrowser
 import logging
-import glob
-
-# 全局 system prompt，作为批改作文的基础指令
-SYSTEM_PROMPT = (
-    '''
-    You are a helpful assistant，帮助用户批改高中英语作文
-    1.优先使用中文回答
-    2.除非用户要求输出其他内容，否则不要过多分析只输出分数，不要建议
-    3.识别不到就打0分
-    4.无论何时输出分数都用这个格式：<score>**分</>，方便中介程序调用
-    '''
+from aeg_engine import (
+    CONFIG_FILE, AI_FAILED, DEFAULT_MAX_CONCURRENCY, DEFAULT_OCR_WORKERS, DEFAULT_BATCH_SIZE,
+    DEFAULT_BATCH_TOKEN_BUDGET, DEFAULT_MAX_RETRIES, DEFAULT_RPM, DEFAULT_TPM,
+    DEFAULT_OCR_CACHE_MB, DEFAULT_LLM_CACHE_MB, DEFAULT_JPEG_QUALITY, DEFAULT_PNG_COMPRESS_LEVEL,
+    DEFAULT_TARGET_DPI, DEFAULT_OCR_BACKEND, DEFAULT_ENSEMBLE_PASSES, DEFAULT_ENSEMBLE_MAX_PASSES,
+    DEFAULT_ENSEMBLE_TOLERANCE, GradingEngine, GradingSettings,
+    close_api_clients
 )
+from aeg_controller import JobController
+from aeg_metrics import format_snapshot
+from aeg_tesseract import TesseractFinder, TesseractScan
+from aeg_scheduler import (
+    DEFAULT_UTC_OFFSET, DEFAULT_WINDOW_END, DEFAULT_WINDOW_START, DiscountWindow, JobQueue, OffPeakScheduler,
+    record_run_history
+)
+
+# 界面检查后台任务事件的间隔（毫秒）
+POLL_INTERVAL_MS = 100
 
 # 日志配置，记录调试信息到 debug.log 文件
 logging.basicConfig(
@@ -33,16 +36,6 @@ logging.basicConfig(
     encoding="utf-8"
 )
 
-CONFIG_FILE = "aeg_config.ini"
-
-def find_tesseract_on_windows():
-    # 全盘搜索 tesseract.exe（只搜 C 盘，速度快些）
-    for root_dir in ["C:\\"]:
-        for path in glob.glob(os.path.join(root_dir, "**", "tesseract.exe"), recursive=True):
-            if os.path.exists(path):
-                return path
-    return None
-
 class EssayGraderApp:
     def __init__(self, root):
         self.root = root
@@ -51,17 +44,50 @@ class EssayGraderApp:
         self.api_key = tk.StringVar()
         self.deepseek_deepthink = tk.BooleanVar()
         self.save_money_mode = tk.BooleanVar()
+        self.max_concurrency = tk.IntVar()
+        self.batch_size = tk.IntVar()
+        self.stream_mode = tk.BooleanVar()
+        self.score_only = tk.BooleanVar()
+        self.ensemble_mode = tk.BooleanVar()
+        self.ocr_workers = DEFAULT_OCR_WORKERS
+        self.bypass_ocr_cache = tk.BooleanVar()
+        self.ocr_preprocess = tk.BooleanVar(value=True)
         self.prompt_title = tk.StringVar()
         self.prompt_criteria = tk.StringVar()
         self.image_paths = []
         self.log_var = tk.StringVar()
+        self.metrics_var = tk.StringVar()
         self.tesseract_path = None
+        self.tesseract_stamp = None
+        # 后台扫描Tesseract时的进度窗口
+        self.tesseract_dialog = None
+        # 省钱模式调度是否正在进行某个任务，用于同步按钮状态
+        self.offpeak_running = False
+        # 批改引擎（OCR、AI请求、缓存），与界面无关
+        self.engine = GradingEngine()
+        # 批改和API测试都在后台运行，界面定时取回进度事件
+        self.jobs = JobController(self.engine)
         self.load_config()
         self.setup_tesseract_path()
         self.create_gui()
         # 初始化评分标准到文本框
         self.text_criteria.delete("1.0", "end")
         self.text_criteria.insert("1.0", self.prompt_criteria.get())
+        # 省钱模式的任务队列，上次未完成的任务启动后自动继续；调度的回调同样经事件队列交给界面线程，
+        # 界面上正在批改时调度不开始新任务
+        self.job_queue = JobQueue()
+        self.scheduler = OffPeakScheduler(
+            self.job_queue,
+            on_event=lambda text: self.jobs.post("offpeak_status", text),
+            on_job_done=lambda job, stats: self.jobs.post("offpeak_done", (job, stats)),
+            hold=lambda: self.jobs.busy,
+        )
+        self.jobs.scheduler = self.scheduler
+        pending = self.job_queue.pending()
+        if pending:
+            self.scheduler.start()
+            self.log_var.set(f"省钱模式：有{len(pending)}个未完成的任务，将在优惠时段继续批改")
+        self.root.after(POLL_INTERVAL_MS, self.poll_jobs)
 
     def load_config(self):
         """加载配置文件，初始化各项参数"""
@@ -74,11 +100,20 @@ class EssayGraderApp:
                 self.api_key.set(self.config.get("API", "key", fallback=""))
                 self.deepseek_deepthink.set(self.config.getboolean("API", "deepthink", fallback=True))
                 self.save_money_mode.set(self.config.getboolean("API", "savemoney", fallback=False))
+                self.max_concurrency.set(self.config.getint("API", "max_concurrency", fallback=DEFAULT_MAX_CONCURRENCY))
+                self.stream_mode.set(self.config.getboolean("API", "stream", fallback=True))
+                self.batch_size.set(self.config.getint("API", "batch_size", fallback=DEFAULT_BATCH_SIZE))
+                self.score_only.set(self.config.getboolean("API", "score_only", fallback=False))
+                self.ensemble_mode.set(self.config.getboolean("ENSEMBLE", "enabled", fallback=False))
+                self.ocr_workers = self.config.getint("OCR", "workers", fallback=DEFAULT_OCR_WORKERS)
+                self.bypass_ocr_cache.set(self.config.getboolean("CACHE", "bypass_ocr", fallback=False))
+                self.ocr_preprocess.set(self.config.getboolean("OCR", "preprocess", fallback=True))
                 # 读取评分标准并将\n还原为换行
                 raw_criteria = self.config.get("PROMPT", "criteria", fallback="")
                 raw_criteria = raw_criteria.replace('\\n', '\n')
                 self.prompt_criteria.set(raw_criteria)
                 self.tesseract_path = self.config.get("OCR", "tesseract_path", fallback=None)
+                self.tesseract_stamp = self.config.get("OCR", "tesseract_stamp", fallback=None)
             else:
                 raise Exception("aeg_config.ini不存在")
         except Exception as e:
@@ -88,6 +123,14 @@ class EssayGraderApp:
             self.api_key.set("")
             self.deepseek_deepthink.set(True)
             self.save_money_mode.set(False)
+            self.max_concurrency.set(DEFAULT_MAX_CONCURRENCY)
+            self.stream_mode.set(True)
+            self.batch_size.set(DEFAULT_BATCH_SIZE)
+            self.score_only.set(False)
+            self.ensemble_mode.set(False)
+            self.ocr_workers = DEFAULT_OCR_WORKERS
+            self.bypass_ocr_cache.set(False)
+            self.ocr_preprocess.set(True)
             self.prompt_criteria.set("")
             self.save_config()  # 直接覆盖旧config，保证下次启动正常
 
@@ -107,36 +150,170 @@ class EssayGraderApp:
             self.config.add_section("PROMPT")
         if not self.config.has_section("OCR"):
             self.config.add_section("OCR")
+        if not self.config.has_section("CACHE"):
+            self.config.add_section("CACHE")
+        if not self.config.has_section("OUTPUT"):
+            self.config.add_section("OUTPUT")
+        if not self.config.has_section("SCHEDULE"):
+            self.config.add_section("SCHEDULE")
+        if not self.config.has_section("ENSEMBLE"):
+            self.config.add_section("ENSEMBLE")
         # 用\n替换换行，保存为一行
         criteria = self.prompt_criteria.get().replace('\n', '\\n')
         self.config.set("API", "type", self.api_type.get())
         self.config.set("API", "key", self.api_key.get())
         self.config.set("API", "deepthink", str(self.deepseek_deepthink.get()))
         self.config.set("API", "savemoney", str(self.save_money_mode.get()))
+        self.config.set("API", "max_concurrency", str(self.get_max_concurrency()))
+        self.config.set("API", "stream", str(self.stream_mode.get()))
+        self.config.set("API", "batch_size", str(self.get_batch_size()))
+        for option, default in (("max_retries", DEFAULT_MAX_RETRIES), ("rpm", DEFAULT_RPM), ("tpm", DEFAULT_TPM)):
+            if not self.config.has_option("API", option):
+                self.config.set("API", option, str(default))
+        if not self.config.has_option("API", "batch_token_budget"):
+            self.config.set("API", "batch_token_budget", str(DEFAULT_BATCH_TOKEN_BUDGET))
+        self.config.set("API", "score_only", str(self.score_only.get()))
+        self.config.set("OCR", "workers", str(self.ocr_workers))
+        self.config.set("CACHE", "bypass_ocr", str(self.bypass_ocr_cache.get()))
+        self.config.set("OCR", "preprocess", str(self.ocr_preprocess.get()))
+        for option, default in (("backend", DEFAULT_OCR_BACKEND), ("target_dpi", DEFAULT_TARGET_DPI),
+                                ("deskew", True), ("binarize", True), ("crop_margin", True)):
+            if not self.config.has_option("OCR", option):
+                self.config.set("OCR", option, str(default))
+        if not self.config.has_option("CACHE", "ocr_max_mb"):
+            self.config.set("CACHE", "ocr_max_mb", str(DEFAULT_OCR_CACHE_MB))
+        if not self.config.has_option("CACHE", "llm"):
+            self.config.set("CACHE", "llm", "True")
+        if not self.config.has_option("CACHE", "llm_max_mb"):
+            self.config.set("CACHE", "llm_max_mb", str(DEFAULT_LLM_CACHE_MB))
+        for option, default in (("image_format", "original"), ("jpeg_quality", DEFAULT_JPEG_QUALITY),
+                                ("png_compress_level", DEFAULT_PNG_COMPRESS_LEVEL), ("comment_overlay", False)):
+            if not self.config.has_option("OUTPUT", option):
+                self.config.set("OUTPUT", option, str(default))
+        for option, default in (("start", DEFAULT_WINDOW_START), ("end", DEFAULT_WINDOW_END),
+                                ("utc_offset", DEFAULT_UTC_OFFSET)):
+            if not self.config.has_option("SCHEDULE", option):
+                self.config.set("SCHEDULE", option, str(default))
+        self.config.set("ENSEMBLE", "enabled", str(self.ensemble_mode.get()))
+        for option, default in (("passes", DEFAULT_ENSEMBLE_PASSES), ("max_passes", DEFAULT_ENSEMBLE_MAX_PASSES),
+                                ("tolerance", DEFAULT_ENSEMBLE_TOLERANCE), ("escalate", True)):
+            if not self.config.has_option("ENSEMBLE", option):
+                self.config.set("ENSEMBLE", option, str(default))
         self.config.set("PROMPT", "criteria", criteria)
         if self.tesseract_path:
             self.config.set("OCR", "tesseract_path", self.tesseract_path)
+        if self.tesseract_stamp:
+            self.config.set("OCR", "tesseract_stamp", self.tesseract_stamp)
         with open(CONFIG_FILE, "w", encoding="utf-8") as f:
             self.config.write(f)
+        # 批改进行中不替换引擎的设置，新设置从下一次批改开始生效
+        if not self.jobs.busy:
+            # API类型或密钥变化后，旧的客户端不再需要
+            self.engine.settings = self.build_settings()
+            close_api_clients(keep=self.engine.api_client_key())
+
+    def get_max_concurrency(self):
+        """读取API并发数，非法值回退为默认值"""
+        try:
+            value = int(self.max_concurrency.get())
+        except (tk.TclError, ValueError):
+            value = DEFAULT_MAX_CONCURRENCY
+        return max(1, value)
+
+    def get_batch_size(self):
+        """每次请求批改的作文篇数，非法值回退为默认值"""
+        try:
+            value = int(self.batch_size.get())
+        except (tk.TclError, ValueError):
+            value = DEFAULT_BATCH_SIZE
+        return max(1, value)
+
+    def build_settings(self):
+        """按当前界面上的设置生成批改引擎的设置"""
+        settings = GradingSettings.from_config(self.config)
+        settings.api_type = self.api_type.get()
+        settings.api_key = self.api_key.get()
+        settings.deepthink = self.deepseek_deepthink.get()
+        settings.max_concurrency = self.get_max_concurrency()
+        settings.ocr_workers = max(1, self.ocr_workers)
+        settings.stream = self.stream_mode.get()
+        settings.score_only = self.score_only.get()
+        settings.batch_size = self.get_batch_size()
+        settings.bypass_ocr_cache = self.bypass_ocr_cache.get()
+        settings.preprocess = self.ocr_preprocess.get()
+        settings.ensemble = self.ensemble_mode.get()
+        settings.tesseract_path = self.tesseract_path
+        return settings
 
     def setup_tesseract_path(self):
-        if sys.platform.startswith("win"):
-            if self.tesseract_path and os.path.exists(self.tesseract_path):
-                pytesseract.pytesseract.tesseract_cmd = self.tesseract_path
-            else:
-                # 没有配置或路径失效，自动搜索
-                found = find_tesseract_on_windows()
-                if found:
-                    self.tesseract_path = found
-                    pytesseract.pytesseract.tesseract_cmd = found
-                    self.save_config()
-                else:
-                    messagebox.showerror("Tesseract-OCR未找到", "未能自动找到Tesseract-OCR，请手动安装并配置。")
-                    sys.exit(1)
+        """依次检查配置中的路径、PATH、注册表和常见安装目录；都没有时在窗口显示后到后台扫描磁盘"""
+        if not sys.platform.startswith("win"):
+            return
+        finder = TesseractFinder()
+        path, stamp = finder.check_cached(self.tesseract_path, self.tesseract_stamp)
+        if path is None:
+            path = finder.find_quick()
+            stamp = finder.stamp(path) if path else None
+        if path:
+            # 路径和校验戳都没变时不必重写配置
+            changed = path != self.tesseract_path or stamp != self.tesseract_stamp
+            self.set_tesseract_path(path, stamp, save=changed)
+        else:
+            # 磁盘扫描可能较慢，放到后台，不阻塞主窗口显示
+            self.root.after(100, lambda: self.start_tesseract_scan(finder))
+
+    def set_tesseract_path(self, path, stamp, save=True):
+        self.tesseract_path = path
+        self.tesseract_stamp = stamp
+        pytesseract.pytesseract.tesseract_cmd = path
+        if save:
+            self.save_config()
+
+    def start_tesseract_scan(self, finder):
+        """后台扫描磁盘查找tesseract.exe，显示进度，可取消后手动选择"""
+        win = tk.Toplevel(self.root)
+        win.title("查找Tesseract-OCR")
+        win.transient(self.root)
+        tk.Label(win, text="未在PATH和常见安装目录中找到Tesseract-OCR，正在扫描磁盘...").pack(padx=10, pady=(10, 5))
+        bar = ttk.Progressbar(win, mode="indeterminate", length=400)
+        bar.pack(padx=10)
+        bar.start(15)
+        detail_var = tk.StringVar(value="准备扫描...")
+        tk.Label(win, textvariable=detail_var, width=60, anchor="w").pack(padx=10, pady=5)
+        self.tesseract_dialog = (win, bar, detail_var, finder)
+        # 扫描线程的回调经事件队列交给界面线程
+        scan = TesseractScan(
+            finder,
+            on_progress=lambda count, directory: self.jobs.post("tesseract_progress", (count, directory)),
+            on_done=lambda found, cancelled: self.jobs.post("tesseract_done", found),
+        ).start()
+        tk.Button(win, text="取消并手动选择", command=scan.cancel).pack(pady=(0, 10))
+        win.protocol("WM_DELETE_WINDOW", scan.cancel)
+
+    def finish_tesseract_scan(self, found):
+        win, bar, _, finder = self.tesseract_dialog
+        self.tesseract_dialog = None
+        bar.stop()
+        win.destroy()
+        if found:
+            self.set_tesseract_path(found, finder.stamp(found))
+            self.log_var.set(f"已找到Tesseract-OCR：{found}")
+        else:
+            self.ask_tesseract_path(finder)
+
+    def ask_tesseract_path(self, finder):
+        path = filedialog.askopenfilename(title="选择tesseract.exe",
+                                          filetypes=[("tesseract.exe", "tesseract.exe"), ("所有文件", "*.*")])
+        if path:
+            self.set_tesseract_path(path, finder.stamp(path))
+        else:
+            messagebox.showerror("Tesseract-OCR未找到", "未能自动找到Tesseract-OCR，请手动安装并配置。")
+            # 在事件处理结束后再关闭，避免之后的定时检查访问已销毁的窗口
+            self.root.after_idle(self.root.destroy)
 
     def create_gui(self):
         # 设置窗口默认大小更大一些
-        self.root.geometry("700x400")
+        self.root.geometry("700x520")
         self.root.resizable(False, False)  # 禁用全屏和缩放
 
         # 右上角菜单优化
@@ -174,15 +351,28 @@ class EssayGraderApp:
         self.lbl_selected = tk.Label(self.root, text="未选择文件")
         self.lbl_selected.grid(row=2, column=1, sticky="w")
 
-        # 批改按钮
-        self.btn_start = tk.Button(self.root, text="开始批改", command=self.start_grading)
-        self.btn_start.grid(row=3, column=0, columnspan=2, pady=15)
+        # 批改按钮，批改进行中可暂停/继续或取消
+        button_frame = tk.Frame(self.root)
+        button_frame.grid(row=3, column=0, columnspan=2, pady=15)
+        self.btn_start = tk.Button(button_frame, text="开始批改", command=self.start_grading)
+        self.btn_start.pack(side="left", padx=5)
+        self.btn_pause = tk.Button(button_frame, text="暂停", command=self.toggle_pause, state="disabled", width=6)
+        self.btn_pause.pack(side="left", padx=5)
+        self.btn_cancel = tk.Button(button_frame, text="取消", command=self.cancel_grading, state="disabled", width=6)
+        self.btn_cancel.pack(side="left", padx=5)
 
         # 日志输出区
         self.log_label = tk.Label(self.root, textvariable=self.log_var, anchor="w", fg="blue", wraplength=600, justify="left")
         self.log_label.grid(row=4, column=0, columnspan=2, sticky="we", padx=5, pady=5)
         self.log_var.set("准备就绪。")
 
+        # 运行状态面板：吞吐、各阶段耗时、队列、缓存命中，看出慢在OCR还是API
+        self.metrics_frame = tk.LabelFrame(self.root, text="运行状态")
+        self.metrics_frame.grid(row=5, column=0, columnspan=2, sticky="we", padx=5, pady=5)
+        tk.Label(self.metrics_frame, textvariable=self.metrics_var, anchor="w", justify="left",
+                 wraplength=600).pack(fill="x", padx=5, pady=2)
+        self.metrics_var.set("尚未开始批改。")
+
     def show_about(self):
         about_text = (
             "英语作文自动批改工具\n"
@@ -211,28 +401,51 @@ class EssayGraderApp:
         tk.Checkbutton(win, text="Deepseek深度思考", variable=self.deepseek_deepthink).grid(row=2, column=1, sticky="w")
         # 新增省钱模式及问号说明
         def show_savemoney_info():
-            messagebox.showinfo("省钱模式说明", "开启后，批改任务会自动延迟到每日00:30-08:30进行（DeepSeek官网此时段有折扣），以节省API费用（需要修改系统睡眠时间保证电脑不会休眠）。")
+            window = DiscountWindow.from_config(self.config)
+            messagebox.showinfo("省钱模式说明", f"开启后，批改任务会加入队列：OCR立即在后台进行，API请求延迟到每日优惠时段"
+                                f"{window.describe()}（DeepSeek官网此时段有折扣），以节省API费用。"
+                                "时段结束时未完成的部分自动暂停，下一个优惠时段继续；关闭程序后再次打开也会继续。"
+                                "（需要修改系统睡眠时间保证电脑不会休眠）")
         frame = tk.Frame(win)
         frame.grid(row=3, column=1, sticky="w")
         tk.Checkbutton(frame, text="省钱模式", variable=self.save_money_mode).pack(side="left")
         tk.Button(frame, text="?", command=show_savemoney_info, width=2).pack(side="left", padx=2)
-        tk.Button(win, text="保存", command=lambda: [self.save_config(), win.destroy()]).grid(row=4, column=0, columnspan=2, pady=10)
+        # API并发数，防止超过服务商限流
+        tk.Label(win, text="API并发数:").grid(row=4, column=0, sticky="e")
+        tk.Spinbox(win, from_=1, to=32, textvariable=self.max_concurrency, width=5).grid(row=4, column=1, sticky="w")
+        # 修改评分标准重新批改时，同一批图片直接复用OCR缓存
+        # 预处理可关闭，对比开关前后的识别效果；两种结果分别缓存
+        ocr_frame = tk.Frame(win)
+        ocr_frame.grid(row=5, column=1, sticky="w")
+        tk.Checkbutton(ocr_frame, text="跳过OCR缓存（重新识别）", variable=self.bypass_ocr_cache).pack(side="left")
+        tk.Checkbutton(ocr_frame, text="OCR前预处理图片", variable=self.ocr_preprocess).pack(side="left")
+        # 流式输出：边生成边显示，分数一出现就能拿到
+        stream_frame = tk.Frame(win)
+        stream_frame.grid(row=6, column=1, sticky="w")
+        tk.Checkbutton(stream_frame, text="流式输出", variable=self.stream_mode).pack(side="left")
+        tk.Checkbutton(stream_frame, text="只要分数（拿到分数即停止生成）", variable=self.score_only).pack(side="left")
+        # 多篇合批：一次请求批改多篇，题目和评分标准只发送一次
+        tk.Label(win, text="每次请求篇数:").grid(row=7, column=0, sticky="e")
+        tk.Spinbox(win, from_=1, to=20, textvariable=self.batch_size, width=5).grid(row=7, column=1, sticky="w")
+        # 多次评分：分数一致即停止，只对分歧大的作文追加评分
+        tk.Checkbutton(win, text="多次评分（分数更稳定，开启后不合批）", variable=self.ensemble_mode).grid(row=8, column=1, sticky="w")
+        tk.Button(win, text="保存", command=lambda: [self.save_config(), win.destroy()]).grid(row=9, column=0, columnspan=2, pady=10)
         # 新增测试API按钮
         def test_api():
-            self.log_var.set("正在测试API...")
-            win.update()
+            if self.jobs.busy:
+                self.log_var.set("正在批改或测试中，请稍后再测试API。")
+                return
             test_prompt = "This is a test essay.使用中文回答，回答“”测试成功”"
-            result, _ = self.ask_ai(test_prompt)
-            if result == "[AI批改失败]":
-                self.log_var.set("API测试失败，请检查API密钥和网络。")
-            else:
-                self.log_var.set("API测试成功，返回内容：" + result[:100].replace('\n', ' '))
-        tk.Button(win, text="测试API", command=test_api).grid(row=5, column=0, columnspan=2, pady=5)
+            self.engine.settings = self.build_settings()
+            # 在后台请求，结果由poll_jobs显示，界面不会卡住
+            self.jobs.test_api(test_prompt)
+            self.log_var.set("正在测试API...")
+        tk.Button(win, text="测试API", command=test_api).grid(row=10, column=0, columnspan=2, pady=5)
 
         # 新增Deepseek余额直链按钮
         def open_deepseek_usage():
             webbrowser.open("https://platform.deepseek.com/usage")
-        tk.Button(win, text="查看Deepseek余额", command=open_deepseek_usage).grid(row=6, column=0, columnspan=2, pady=5)
+        tk.Button(win, text="查看Deepseek余额", command=open_deepseek_usage).grid(row=11, column=0, columnspan=2, pady=5)
 
     def select_files(self):
         files = filedialog.askopenfilenames(
@@ -255,32 +468,10 @@ class EssayGraderApp:
             self.lbl_selected.config(text="未选择文件")
 
     def start_grading(self):
-        # 防止多次点击，立即提示
-        self.log_var.set("正在批改，请稍候...")
-        self.root.update()  # 立即刷新界面
-        if self.save_money_mode.get():
-            now = datetime.datetime.now()
-            # 判断当前是否在00:30-08:30之外
-            start = now.replace(hour=0, minute=30, second=0, microsecond=0)
-            end = now.replace(hour=8, minute=30, second=0, microsecond=0)
-            if not (start <= now <= end):
-                # 计算下一个00:30
-                if now < start:
-                    wait_until = start
-                else:
-                    wait_until = (now + datetime.timedelta(days=1)).replace(hour=0, minute=30, second=0, microsecond=0)
-                wait_seconds = (wait_until - now).total_seconds()
-                messagebox.showinfo("省钱模式", f"省钱模式已开启，将于{wait_until.strftime('%Y-%m-%d %H:%M')}自动开始批改。\n\n你可以关闭本弹窗，届时会自动执行。")
-                self.log_var.set(f"省钱模式：等待到{wait_until.strftime('%Y-%m-%d %H:%M')}再开始批改...")
-                def delayed_start():
-                    import time
-                    time.sleep(wait_seconds)
-                    self.root.after(0, self._real_start_grading)
-                threading.Thread(target=delayed_start, daemon=True).start()
-                return
-        self._real_start_grading()
-
-    def _real_start_grading(self):
+        # 防止重复开始；省钱模式任务进行中时不能手动批改，避免同一批图片被批改两次，但可以继续加入队列
+        if self.jobs.busy or (self.jobs.scheduler_busy and not self.save_money_mode.get()):
+            messagebox.showinfo("提示", "正在批改、测试API或进行省钱模式任务，请等待完成或先取消。")
+            return
         if not self.image_paths:
             messagebox.showerror("错误", "请先选择图片文件")
             return
@@ -294,228 +485,149 @@ class EssayGraderApp:
             messagebox.showerror("错误", "请填写评分标准")
             return
         self.save_config()
-        threading.Thread(target=self._grading_worker, daemon=True).start()
-
-    def _grading_worker(self):
+        if self.save_money_mode.get():
+            self.submit_offpeak_job()
+            return
         out_dir = os.path.join(os.path.dirname(self.image_paths[0]), "批改结果")
-        os.makedirs(out_dir, exist_ok=True)
-        for idx, img_path in enumerate(self.image_paths):
-            text = self.ocr_image(img_path)
-            prompt = f"作文题目：{self.prompt_title.get()}\n评分标准：{self.prompt_criteria.get()}\n学生作文：{text}\n请根据评分标准批改并给出建议。"
-            result, usage = self.ask_ai(prompt)
-            self.write_result_on_image(img_path, result, out_dir, usage)
-            short_result = result[:100].replace('\n', ' ') + ("..." if len(result) > 100 else "")
-            self.root.after(0, lambda idx=idx, short_result=short_result: self._update_progress(idx, short_result))
-        self.root.after(0, lambda: self._grading_done(out_dir))
-
-    def _update_progress(self, idx, short_result):
-        self.lbl_selected.config(text=f"正在批改第{idx+1}/{len(self.image_paths)}张...")
-        self.log_var.set(f"第{idx+1}张完成，AI回复：{short_result}")
-        self.root.update()
-
-    def _grading_done(self, out_dir):
-        # 整合所有txt内容到total.txt，并统计总token
-        try:
-            import datetime
-            txt_files = [f for f in os.listdir(out_dir) if f.lower().endswith(".txt") and f != "total.txt"]
-            total_path = os.path.join(out_dir, "total.txt")
-            total_prompt_tokens = 0
-            total_completion_tokens = 0
-
-            # 先统计所有token
-            for txt_file in txt_files:
-                file_path = os.path.join(out_dir, txt_file)
-                with open(file_path, "r", encoding="utf-8") as f:
-                    content = f.read()
-                # 简单正则提取token数
-                import re
-                prompt_match = re.search(r"上传token数:\s*(\d+)", content)
-                completion_match = re.search(r"回复token数:\s*(\d+)", content)
-                if prompt_match:
-                    total_prompt_tokens += int(prompt_match.group(1))
-                if completion_match:
-                    total_completion_tokens += int(completion_match.group(1))
-
-            # 写入统计和详细内容
-            with open(total_path, "w", encoding="utf-8") as total_f:
-                now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                total_f.write(f"【统计时间】{now_str}\n")
-                total_f.write(f"【总上传token数】: {total_prompt_tokens}\n")
-                total_f.write(f"【总回复token数】: {total_completion_tokens}\n\n")
-                for txt_file in txt_files:
-                    file_path = os.path.join(out_dir, txt_file)
-                    with open(file_path, "r", encoding="utf-8") as f:
-                        content = f.read()
-                    total_f.write(f"===== {txt_file} =====\n")
-                    total_f.write(content)
-                    total_f.write("\n\n")
-        except Exception as e:
-            print(f"整合txt失败: {e}")
+        self.jobs.start_grading(self.image_paths, self.prompt_title.get(), self.prompt_criteria.get(), out_dir)
+        self.log_var.set("正在批改，请稍候...")
+        self.set_running(True)
+
+    def set_running(self, running, offpeak=False):
+        # 省钱模式任务进行中仍可选择图片加入队列
+        self.btn_start.config(state="disabled" if running and not offpeak else "normal")
+        self.btn_select.config(state="disabled" if running and not offpeak else "normal")
+        self.btn_pause.config(state="normal" if running else "disabled", text="暂停")
+        self.btn_cancel.config(state="normal" if running else "disabled")
+
+    def toggle_pause(self):
+        if self.jobs.paused:
+            self.jobs.resume()
+            self.btn_pause.config(text="暂停")
+            self.log_var.set("已继续批改。")
+        else:
+            self.jobs.pause()
+            self.btn_pause.config(text="继续")
+            self.log_var.set("已暂停：正在进行的请求完成后不再发出新请求。")
+
+    def cancel_grading(self):
+        if self.jobs.busy:
+            question = "确定取消吗？已完成的作文会保留，下次批改同一批图片时从未完成的部分继续。"
+        else:
+            question = "确定取消正在进行的省钱模式任务吗？任务将移出队列，已完成的作文会保留，下次批改同一批图片时从未完成的部分继续。"
+        if not messagebox.askyesno("取消批改", question):
+            return
+        self.jobs.cancel()
+        self.btn_pause.config(state="disabled")
+        self.btn_cancel.config(state="disabled")
+        self.log_var.set("正在取消，等待进行中的请求结束...")
 
-        messagebox.showinfo("完成", f"全部批改完成，结果已保存到：{out_dir}")
-        self.log_var.set("全部批改完成！")
+    def submit_offpeak_job(self):
+        """省钱模式：加入任务队列，由后台调度在优惠时段批改"""
+        out_dir = os.path.join(os.path.dirname(self.image_paths[0]), "批改结果")
+        essays = len(self.image_paths)
+        job = self.scheduler.submit(self.image_paths, self.prompt_title.get(), self.prompt_criteria.get(), out_dir)
+        window = DiscountWindow.from_config(self.config)
+        settings = self.engine.settings
+        minutes = self.job_queue.estimate_minutes(essays, settings.max_concurrency, settings.tpm)
+        if window.is_open():
+            when = "当前处于优惠时段，OCR完成后立即开始批改。"
+        else:
+            when = (f"OCR现在就在后台进行，批改将于{window.local_text(window.next_start())}"
+                    f"（优惠时段{window.describe()}）自动开始。")
+        messagebox.showinfo("省钱模式", f"已加入省钱模式队列（任务{job['id']}，{essays}篇，预计批改约{minutes:.0f}分钟）。\n\n"
+                            f"{when}\n\n时段结束时未完成的部分会暂停到下一个优惠时段；关闭程序后再次打开也会继续。")
+        self.log_var.set(f"省钱模式：任务{job['id']}已加入队列")
         self.lbl_selected.config(text="未选择文件")
         self.image_paths = []
 
-    def ocr_image(self, img_path):
-        if sys.platform.startswith("win") and self.tesseract_path:
-            pytesseract.pytesseract.tesseract_cmd = self.tesseract_path
-        try:
-            img = Image.open(img_path)
-            # 自动尝试中英文混合识别
-            text = pytesseract.image_to_string(img, lang="eng+chi_sim")
-            text = text.strip()
-            # 简单清洗：去除多余空行
-            text = "\n".join([line.strip() for line in text.splitlines() if line.strip()])
-            print(f"OCR识别结果：{repr(text)}")  # 控制台输出便于调试
-            if not text or len(text) < 10:
-                return "[图片识别失败]"
-            return text
-        except Exception as e:
-            print(f"OCR异常: {e}")
-            return "[图片识别失败]"
-
-    def ask_ai(self, prompt):
-        if self.api_type.get() == "ChatGPT":
-            return self.ask_chatgpt(prompt)
+    def on_offpeak_job_done(self, job, stats):
+        out_dir = job["out_dir"]
+        if stats.get("failed"):
+            message = (f"任务{job['id']}批改结束，其中{stats['failed']}张失败，结果已保存到：{out_dir}\n\n"
+                       "重新选择这些图片再次批改，将只重试失败和未完成的作文。")
         else:
-            return self.ask_deepseek(prompt)
-
-    def ask_chatgpt(self, prompt):
-        try:
-            from openai import OpenAI
-            client = OpenAI(
-                api_key=self.api_key.get(),
-                base_url="https://api.openai.com/v1"
-            )
-            messages = [
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": prompt}
-            ]
-            logging.info("[ChatGPT] 发送内容: %r", messages)
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=messages,
-                stream=False
-            )
-            logging.info("[ChatGPT] 返回内容: %r", response.choices[0].message.content)
-            usage = getattr(response, "usage", None)
-            if usage:
-                logging.info("[ChatGPT] usage: %r", usage)
-            return response.choices[0].message.content, usage
-        except Exception as e:
-            logging.error("[ChatGPT] 异常: %s", e)
-            return "[AI批改失败]", None
+            message = f"任务{job['id']}全部批改完成，结果已保存到：{out_dir}"
+        messagebox.showinfo("省钱模式", message)
 
-    def ask_deepseek(self, prompt):
+    def poll_jobs(self):
+        """处理后台任务发来的事件，之后定时再次检查"""
         try:
-            from openai import OpenAI
-            client = OpenAI(
-                api_key=self.api_key.get(),
-                base_url="https://api.deepseek.com"
-            )
-            model_name = "deepseek-reasoner" if self.deepseek_deepthink.get() else "deepseek-chat"
-            messages = [
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": prompt}
-            ]
-            logging.info("[DeepSeek] 发送内容: %r", messages)
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                stream=False
-            )
-            content = response.choices[0].message.content
-            reasoning_content = getattr(response.choices[0].message, "reasoning_content", None)
-            usage = getattr(response, "usage", None)
-            if usage:
-                logging.info("[DeepSeek] usage: %r", usage)
-            if reasoning_content:
-                logging.info("[DeepSeek] 思维链: %r", reasoning_content)
-                return content + "\n\n【思维链】\n" + reasoning_content, usage
-            else:
-                return content, usage
-        except Exception as e:
-            logging.error("[DeepSeek] 异常: %s", e)
-            return "[AI批改失败]", None
-
-    def write_result_on_image(self, img_path, result, out_dir, usage=None):
-        try:
-            import re
-            match = re.search(r"<score>(.*?)</>", result)
-            if match:
-                score_text = match.group(1).strip()
-            else:
-                score_text = "无分数"
-
-            img = Image.open(img_path).convert("RGB")
-            width, height = img.size
-
-            # 字体选择同前
-            if sys.platform.startswith("win"):
-                font_path_candidates = [
-                    "C:/Windows/Fonts/msyh.ttc",
-                    "C:/Windows/Fonts/simhei.ttf",
-                    "C:/Windows/Fonts/simsun.ttc",
-                    "C:/Windows/Fonts/NotoSansSC-Regular.otf"
-                ]
-            elif sys.platform == "darwin":
-                font_path_candidates = [
-                    "/System/Library/Fonts/PingFang.ttc",
-                    "/System/Library/Fonts/STHeiti Medium.ttc",
-                    "/Library/Fonts/Songti.ttc",
-                    "/Library/Fonts/SimHei.ttf",
-                    "/Library/Fonts/NotoSansSC-Regular.otf"
-                ]
-            else:
-                font_path_candidates = [
-                    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
-                    "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
-                    "/usr/share/fonts/truetype/arphic/ukai.ttc",
-                    "/usr/share/fonts/truetype/arphic/uming.ttc"
-                ]
-
-            font = None
-            for font_path in font_path_candidates:
-                if os.path.exists(font_path):
-                    try:
-                        font = ImageFont.truetype(font_path, 40)
-                        break
-                    except Exception:
-                        continue
-            if font is None:
-                font = ImageFont.load_default()
-
-            draw = ImageDraw.Draw(img)
-            y = 5
-            draw.text((20, y), score_text, fill=(255, 0, 0), font=font)
-
-            img = img.convert("RGB")
-            base = os.path.basename(img_path)
-            img.save(os.path.join(out_dir, base))
-
-            txt_name = os.path.splitext(base)[0] + ".txt"
-            ocr_text = ""
-            try:
-                ocr_text = self.ocr_image(img_path)
-            except Exception as e:
-                ocr_text = "[获取OCR内容失败]"
-            with open(os.path.join(out_dir, txt_name), "w", encoding="utf-8") as f:
-                f.write("【OCR识别内容】\n")
-                f.write(ocr_text + "\n\n")
-                f.write("【AI批改内容】\n")
-                f.write(result + "\n\n")
-                if usage:
-                    # 只写总token数
-                    prompt_tokens = getattr(usage, "prompt_tokens", None)
-                    completion_tokens = getattr(usage, "completion_tokens", None)
-                    f.write("【API用量统计】\n")
-                    if prompt_tokens is not None:
-                        f.write(f"上传token数: {prompt_tokens}\n")
-                    if completion_tokens is not None:
-                        f.write(f"回复token数: {completion_tokens}\n")
-        except Exception as e:
-            print(f"P图失败: {e}")
+            self._handle_job_events(self.jobs.poll())
+        except Exception:
+            # 单个事件处理出错不能让界面停止检查后台任务
+            logging.exception("[任务] 处理后台事件出错")
+        finally:
+            self.root.after(POLL_INTERVAL_MS, self.poll_jobs)
+
+    def _handle_job_events(self, events):
+        progress = None
+        for event, data in events:
+            if event == "progress":
+                # 同一次检查中只显示最新进度
+                progress = data
+            elif event == "status":
+                self.log_var.set(data)
+            elif event == "metrics":
+                self.metrics_var.set(format_snapshot(data))
+            elif event == "done":
+                out_dir, stats = data
+                # 手动批改的耗时也记入历史，让省钱模式的时间估算更准
+                record_run_history(self.job_queue, self.engine.metrics.snapshot(), self.engine.settings.max_concurrency)
+                progress = None
+                self._grading_done(out_dir, stats)
+            elif event == "api_test":
+                if data == AI_FAILED:
+                    self.log_var.set("API测试失败，请检查API密钥和网络。")
+                else:
+                    self.log_var.set("API测试成功，返回内容：" + data[:100].replace('\n', ' '))
+            elif event == "error":
+                self.set_running(False)
+                self.log_var.set(data)
+                messagebox.showerror("错误", data)
+            elif event == "offpeak_status":
+                self.log_var.set(f"省钱模式：{data}")
+            elif event == "offpeak_done":
+                self.on_offpeak_job_done(*data)
+            elif event == "tesseract_progress" and self.tesseract_dialog:
+                self.tesseract_dialog[2].set(f"已扫描{data[0]}个目录：{data[1]}")
+            elif event == "tesseract_done" and self.tesseract_dialog:
+                self.finish_tesseract_scan(data)
+        if progress is not None:
+            self._update_progress(*progress)
+        # 省钱模式任务开始或结束时切换按钮，进行中可以暂停和取消
+        offpeak = self.jobs.scheduler_busy
+        if offpeak != self.offpeak_running:
+            self.offpeak_running = offpeak
+            if not self.jobs.busy:
+                self.set_running(offpeak, offpeak=True)
+
+    def _update_progress(self, done, total, result):
+        if result["status"] == "cancelled":
+            self.lbl_selected.config(text=f"已完成{done}/{total}张...")
+            self.log_var.set(f"第{done}张已取消，未批改。")
+            return
+        text = (result["result"] or "") if result["status"] != "failed" else AI_FAILED
+        short_result = text[:100].replace('\n', ' ') + ("..." if len(text) > 100 else "")
+        self.lbl_selected.config(text=f"已完成{done}/{total}张...")
+        self.log_var.set(f"第{done}张完成，AI回复：{short_result}")
+
+    def _grading_done(self, out_dir, stats=None):
+        # total.txt、summary.csv、summary.json已由批改引擎根据本次运行清单生成
+        self.set_running(False)
+        if stats and stats.get("cancelled"):
+            messagebox.showinfo("已取消", f"批改已取消，{stats['cancelled']}张未批改，已完成的结果保存在：{out_dir}\n\n"
+                                "重新选择这些图片再次批改，将从未完成的部分继续。")
+            self.log_var.set(f"批改已取消，{stats['cancelled']}张未批改。")
+        elif stats and stats.get("failed"):
+            messagebox.showwarning("完成", f"批改结束，其中{stats['failed']}张失败，结果已保存到：{out_dir}\n\n"
+                                   "重新选择这些图片再次批改，将只重试失败和未完成的作文。")
+            self.log_var.set(f"批改结束，{stats['failed']}张失败。")
+        else:
+            messagebox.showinfo("完成", f"全部批改完成，结果已保存到：{out_dir}")
+            self.log_var.set("全部批改完成！")
+        self.lbl_selected.config(text="未选择文件")
+        self.image_paths = []
 
 if __name__ == "__main__":
     root = tk.Tk()
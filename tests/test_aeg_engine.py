@@ -0,0 +1,130 @@
+"""批改引擎的续批测试：用内存中的OCR后端，不需要Tesseract，也不发API请求"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aeg_engine import (
+    JOURNAL_FILE, GradingEngine, GradingSettings, JobJournal, RunManifest, make_cache_key, output_paths
+)
+from aeg_ocr import OCRBackend, register_backend
+
+TITLE = "My School"
+CRITERIA = "满分15分"
+
+class CountingOCRBackend(OCRBackend):
+    name = "test-counting"
+    calls = 0
+
+    def version(self):
+        return "test"
+
+    def image_to_string(self, img, lang):
+        CountingOCRBackend.calls += 1
+        return "This is a test essay about my school and my friends."
+
+register_backend(CountingOCRBackend.name, CountingOCRBackend)
+
+class OcrOnlyResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="aeg_test_")
+        self.out_dir = os.path.join(self.work_dir, "out")
+        os.makedirs(self.out_dir)
+        self.paths = []
+        for i in range(3):
+            path = os.path.join(self.work_dir, f"essay_{i}.png")
+            Image.new("RGB", (64, 64), (255, 255, 255 - i)).save(path)
+            self.paths.append(path)
+        settings = GradingSettings(api_type="ChatGPT", api_key="test", ocr_backend=CountingOCRBackend.name,
+                                   preprocess=False, cache_file=os.path.join(self.work_dir, "cache.sqlite"),
+                                   llm_cache=False, max_retries=0)
+        self.engine = GradingEngine(settings)
+        CountingOCRBackend.calls = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_prefetch_skips_essay_written_without_ocr_text(self):
+        # 空白页：识别失败不记录识别结果，但已经批改并写出
+        journal = JobJournal(os.path.join(self.out_dir, JOURNAL_FILE),
+                             make_cache_key(TITLE, CRITERIA, self.engine.current_model()))
+        blank = self.paths[0]
+        journal.record(blank, "pending")
+        journal.record(blank, "graded", result="<score>0分</> 空白", usage=None, score="0分", cached=False)
+        journal.record(blank, "written")
+        journal.close()
+        for output in output_paths(blank, self.out_dir):
+            open(output, "w").close()
+
+        results, stats = self.engine.run(self.paths, TITLE, CRITERIA, out_dir=self.out_dir, ocr_only=True)
+
+        self.assertEqual(results, [])
+        self.assertEqual(stats["resumed"], 1)
+        self.assertEqual(CountingOCRBackend.calls, 2)
+        journal = JobJournal(os.path.join(self.out_dir, JOURNAL_FILE),
+                             make_cache_key(TITLE, CRITERIA, self.engine.current_model()))
+        self.assertEqual([journal.state(path) for path in self.paths], ["written", "ocr_done", "ocr_done"])
+        journal.close()
+
+class BrokenCache:
+    """读取时总是出错的缓存，模拟数据库损坏或被锁"""
+
+    def get(self, key):
+        raise sqlite3.OperationalError("database is locked")
+
+    def put(self, key, value):
+        raise sqlite3.OperationalError("database is locked")
+
+class StageErrorTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="aeg_test_")
+        self.out_dir = os.path.join(self.work_dir, "out")
+        os.makedirs(self.out_dir)
+        self.paths = []
+        for i in range(2):
+            path = os.path.join(self.work_dir, f"essay_{i}.png")
+            Image.new("RGB", (64, 64), (255, 255, 255 - i)).save(path)
+            self.paths.append(path)
+        settings = GradingSettings(api_type="ChatGPT", api_key="test", ocr_backend=CountingOCRBackend.name,
+                                   preprocess=False, cache_file=os.path.join(self.work_dir, "cache.sqlite"),
+                                   llm_cache=False, max_retries=0)
+        self.engine = GradingEngine(settings)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_stage_exception_marks_essay_failed(self):
+        def broken_api(*args, **kwargs):
+            raise sqlite3.OperationalError("database is locked")
+
+        self.engine.ocr_cache = BrokenCache()
+        self.engine.ask_ai_cached = broken_api
+        results, stats = self.engine.run(self.paths, TITLE, CRITERIA, out_dir=self.out_dir)
+
+        self.assertEqual(sorted(result["image"] for result in results), self.paths)
+        self.assertEqual([result["status"] for result in results], ["failed", "failed"])
+        self.assertEqual(stats["failed"], 2)
+        journal = JobJournal(os.path.join(self.out_dir, JOURNAL_FILE),
+                             make_cache_key(TITLE, CRITERIA, self.engine.current_model()))
+        self.assertEqual([journal.state(path) for path in self.paths], ["failed", "failed"])
+        journal.close()
+
+class RunManifestTest(unittest.TestCase):
+    def test_runs_in_same_second_get_separate_files(self):
+        out_dir = tempfile.mkdtemp(prefix="aeg_test_")
+        try:
+            first, second = RunManifest(out_dir), RunManifest(out_dir)
+            self.assertNotEqual(first.path, second.path)
+            first.close()
+            second.close()
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+"""用假的Windows文件系统测试TesseractFinder的快速查找和后台扫描，不需要Windows和真实的Tesseract"""
+import ntpath
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aeg_tesseract import TesseractFinder, TesseractScan
+
+class FakeWindowsFileSystem:
+    """内存中的Windows文件系统：files为文件路径，dirs为额外的空目录，路径不区分大小写"""
+
+    def __init__(self, files=(), dirs=(), env=None, registry=None, drives=("C:\\",)):
+        self.files = {path.lower() for path in files}
+        # 小写路径 -> 原始大小写的路径
+        self.dirs = {}
+        for path in list(files) + list(dirs):
+            parent = path if path in dirs else ntpath.dirname(path)
+            while parent and parent.lower() not in self.dirs:
+                self.dirs[parent.lower()] = parent
+                if ntpath.dirname(parent) == parent:
+                    break
+                parent = ntpath.dirname(parent)
+        self.env = env or {}
+        self.registry = registry or {}
+        self._drives = list(drives)
+
+    def is_file(self, path):
+        return path.lower() in self.files
+
+    def list_dirs(self, path):
+        prefix = path.lower().rstrip("\\") + "\\"
+        children = set()
+        for lowered, original in self.dirs.items():
+            if lowered.startswith(prefix) and "\\" not in lowered[len(prefix):]:
+                children.add(ntpath.basename(original))
+        return sorted(children)
+
+    def getenv(self, name):
+        return self.env.get(name)
+
+    def registry_value(self, hive, key, name):
+        return self.registry.get((hive, key, name))
+
+    def drives(self):
+        return list(self._drives)
+
+class FindQuickTest(unittest.TestCase):
+    def test_path_first(self):
+        fs = FakeWindowsFileSystem(
+            files=["D:\\tools\\tess\\tesseract.exe", "C:\\Program Files\\Tesseract-OCR\\tesseract.exe"],
+            env={"PATH": "C:\\Windows;\"D:\\tools\\tess\"", "ProgramFiles": "C:\\Program Files"},
+        )
+        self.assertEqual(TesseractFinder(fs, windows=True).find_quick(), "D:\\tools\\tess\\tesseract.exe")
+
+    def test_registry_install_dir(self):
+        fs = FakeWindowsFileSystem(
+            files=["E:\\OCR\\tesseract.exe"],
+            registry={("HKEY_LOCAL_MACHINE", "SOFTWARE\\Tesseract-OCR", "InstallDir"): "E:\\OCR"},
+        )
+        self.assertEqual(TesseractFinder(fs, windows=True).find_quick(), "E:\\OCR\\tesseract.exe")
+
+    def test_fallback_dirs_without_env(self):
+        fs = FakeWindowsFileSystem(files=["C:\\Program Files (x86)\\Tesseract-OCR\\tesseract.exe"])
+        self.assertEqual(TesseractFinder(fs, windows=True).find_quick(),
+                         "C:\\Program Files (x86)\\Tesseract-OCR\\tesseract.exe")
+
+class ScanTest(unittest.TestCase):
+    def test_scan_finds_nested_install(self):
+        fs = FakeWindowsFileSystem(
+            files=["D:\\Apps\\OCR\\Tesseract\\tesseract.exe"],
+            dirs=["C:\\Program Files\\Other", "C:\\Windows\\System32"],
+            drives=("C:\\", "D:\\"),
+        )
+        self.assertEqual(TesseractFinder(fs, windows=True).scan(), "D:\\Apps\\OCR\\Tesseract\\tesseract.exe")
+
+    def test_scan_skips_windows_dir_and_respects_depth(self):
+        fs = FakeWindowsFileSystem(files=["C:\\Windows\\tesseract.exe", "C:\\a\\b\\c\\tesseract.exe"])
+        finder = TesseractFinder(fs, windows=True)
+        self.assertIsNone(finder.scan(max_depth=2))
+        self.assertEqual(finder.scan(max_depth=3), "C:\\a\\b\\c\\tesseract.exe")
+
+    def test_background_scan_cancel(self):
+        fs = FakeWindowsFileSystem(files=["C:\\x\\tesseract.exe"])
+        done = threading.Event()
+        outcome = []
+        scan = TesseractScan(TesseractFinder(fs, windows=True),
+                             on_done=lambda found, cancelled: (outcome.append((found, cancelled)), done.set()))
+        scan.cancel()
+        scan.start()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(outcome, [(None, True)])
+
+if __name__ == "__main__":
+    unittest.main()